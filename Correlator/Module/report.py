@@ -43,6 +43,17 @@ class Report(Module):
     def initialize(self):
         self.log.debug('Initialize no-op')
 
+    def merge_stores(self, stores: list):
+
+        merged = super().merge_stores(stores)
+
+        starts = [store.start for store in stores if store.start is not None]
+        ends = [store.end for store in stores if store.end is not None]
+        merged.start = min(starts, default=None)
+        merged.end = max(ends, default=None)
+
+        return merged
+
     def _clear_stats(self):
 
         self.log.debug('Clear Stats')
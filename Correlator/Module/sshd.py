@@ -5,12 +5,16 @@ Process: logins
 
 """
 
-import re
-from datetime import datetime, timedelta
-from dataclasses import dataclass, field
+import gc
+import sys
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+from operator import attrgetter
 
 from Correlator.Event.core import Event, StatsEvent, EventSeverity
-from Correlator.util import Module, CountOverTime, format_timestamp
+from Correlator.util import (Module, MessageClassifier, SessionTracker,
+                             SlidingWindowCounter, SpaceSaving,
+                             format_timestamp)
 from Correlator.config_store import ConfigType
 
 SSHDConfig = [
@@ -36,6 +40,42 @@ SSHDConfig = [
             'desc': 'How many minutes after creation a transaction is valid',
             'type': ConfigType.INTEGER
         }
+    },
+    {
+        'max_tracked_hosts': {
+            'default': 100000,
+            'desc': 'Most remote hosts to count login failures for. The '
+                    'hosts with the oldest failures are forgotten beyond '
+                    'it. 0 means no limit.',
+            'type': ConfigType.INTEGER
+        }
+    },
+    {
+        'lockout_cooldown': {
+            'default': 3600,
+            'desc': 'Seconds after SSHDAttemptsExceeded is dispatched for a '
+                    'host during which it is not dispatched again for that '
+                    'host. The attempts are counted, and reported by '
+                    'SSHDAttemptsSuppressed when the cooldown ends. 0 '
+                    'dispatches it for every attempt over the limit.',
+            'type': ConfigType.INTEGER
+        }
+    },
+    {
+        'top_capacity': {
+            'default': 1000,
+            'desc': 'Number of remote hosts, and of users, the heavy hitter '
+                    'counts of failed logins are kept for',
+            'type': ConfigType.INTEGER
+        }
+    },
+    {
+        'top_reported': {
+            'default': 10,
+            'desc': 'Number of remote hosts, and of users, with the most '
+                    'failed logins reported in the statistics',
+            'type': ConfigType.INTEGER
+        }
     }
 
 ]
@@ -100,38 +140,218 @@ class SSHDAttemptsExceeded(Event):
     severity_override = EventSeverity.Error
 
 
+class SSHDAttemptsSuppressed(Event):
+
+    schema = [
+        ['host', 'Remote host'],
+        ['suppressed', 'Suppressed attempts'],
+        ['start', 'Cooldown start'],
+        ['finish', 'Last suppressed attempt']
+    ]
+
+    templates = {
+        'text/plain': {
+            'summary': 'The host at ${host} made ${suppressed} more failed login attempt(s) over the limit between ${start} and ${finish}'
+        }
+    }
+
+    severity_override = EventSeverity.Error
+
+
 class SSHDStats(StatsEvent):
 
     schema = [
         ['login_sessions', 'Login sessions'],
         ['denied', 'Denied logins'],
         ['lockouts', 'Host lockouts'],
+        ['suppressed', 'Suppressed lockouts'],
         ['expired', 'Expired transactions'],
         ['partial', 'Partial transactions'],
+        ['top_addresses', 'Hosts with the most failed logins'],
+        ['top_users', 'Users with the most failed logins'],
     ]
     templates = {
         'text/plain': {
-            'summary': 'Statistics: ${login_sessions} logion session(s), ${denied} denied login(s),  ${lockouts} host lockout(s), ${expired} expired transaction(s), ${partial} partial transaction(s)'
+            'summary': 'Statistics: ${login_sessions} logion session(s), ${denied} denied login(s),  ${lockouts} host lockout(s), ${suppressed} suppressed lockout(s), ${expired} expired transaction(s), ${partial} partial transaction(s), top failed login hosts: ${top_addresses}, users: ${top_users}'
         }
     }
 
 
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+@dataclass(slots=True)
+class SSHDTransaction:
+    """ A login, from authentication until the session is closed
+
+    There is one for every open session, so it is slotted, and keeps its
+    state and timestamp itself rather than in dicts of its own. create
+    interns the strings that repeat across sessions, such as users and
+    addresses. On its own, as in journal entries, it pickles as a tuple of
+    its fields, made back into a transaction by _make_txn. SSHDStore pickles
+    all of its transactions together, as columns (see pack_transactions).
+
+    """
+
+    state: int = 0
+    timestamp: datetime = None
+    auth: str = None
+    user: str = None
+    addr: str = None
+    port: str = None
+    key: str = None
+    failures: int = 0
+    start: datetime = None
+    finish: datetime = None
+
+    def __reduce__(self):
+        return _make_txn, (
+            self.state, self.timestamp, self.auth, self.user, self.addr,
+            self.port, self.key, self.failures, self.start, self.finish)
+
+    def fields(self, names: list[str]) -> dict:
+        """Returns the named fields, as event data"""
+        return {name: getattr(self, name) for name in names}
+
+    @classmethod
+    def create(cls, state: int = 0, **fields) -> 'SSHDTransaction':
+        """Makes a transaction, with its strings interned"""
+        return cls(state, **{name: _intern(value)
+                             for (name, value) in fields.items()})
+
+    @classmethod
+    def from_dict(cls, state: int, payload: dict) -> 'SSHDTransaction':
+        """Converts a transaction dict, from a store written before this"""
+        return cls.create(state, **payload)
+
+
+def _make_txn(state, timestamp, auth, user, addr, port, key, failures, start,
+              finish) -> SSHDTransaction:
+    """Unpickles an SSHDTransaction from its fields, in order
+
+    The slots are set directly, rather than through the dataclass __init__.
+    Stores pickled before this name SSHDTransaction itself, which still
+    loads them.
+
+    """
+
+    txn = object.__new__(SSHDTransaction)
+    txn.state = state
+    txn.timestamp = timestamp
+    txn.auth = auth
+    txn.user = user
+    txn.addr = addr
+    txn.port = port
+    txn.key = key
+    txn.failures = failures
+    txn.start = start
+    txn.finish = finish
+    return txn
+
+
+def pack_transactions(transactions: dict) -> tuple[list, list[list]]:
+    """Returns the identifiers, and a column of values per field
+
+    Columns of plain values pickle and unpickle much faster than an object
+    per transaction, which needs a call to _make_txn each on load.
+
+    """
+
+    values = list(transactions.values())
+    return list(transactions), [list(map(attrgetter(name), values))
+                                for name in SSHDTransaction.__slots__]
+
+
+def unpack_transactions(packed: tuple[list, list[list]]) -> dict:
+    """Makes the transactions back from pack_transactions
+
+    They are made in bulk, with the garbage collector off. None of them are
+    garbage, so it would only go over them again and again as they are
+    made.
+
+    """
+
+    (identifiers, columns) = packed
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return dict(zip(identifiers, map(_make_txn, *columns)))
+    finally:
+        if enabled:
+            gc.enable()
+
+
+@dataclass(slots=True)
+class SSHDLockout:
+    """ A host in its lockout cooldown
+
+    timestamp is when SSHDAttemptsExceeded was dispatched for it. The
+    session tracker ends the cooldown lockout_cooldown seconds after it.
+
+    """
+
+    state: int = 0
+    timestamp: datetime = None
+    suppressed: int = 0
+    last: datetime = None
+
+    def __reduce__(self):
+        return SSHDLockout, (self.state, self.timestamp, self.suppressed,
+                             self.last)
+
+
 @dataclass
 class SSHDStore:
 
     host_store: dict = field(default_factory=lambda: {})
+
+    # States are kept in the transactions. This holds those of stores
+    # written before, until their transactions are converted.
+
     states: dict = field(default_factory=lambda: {})
     transactions: dict = field(default_factory=lambda: {})
+    lockout_hosts: dict = field(default_factory=lambda: {})
+
+    # Failed logins by remote address, and by user, for SpaceSaving
+
+    top_addresses: dict = field(default_factory=lambda: {})
+    top_users: dict = field(default_factory=lambda: {})
     login_sessions: int = 0
     denied: int = 0
     lockouts: int = 0
+    suppressed: int = 0
     expired: int = 0
 
+    def __getstate__(self):
+        state = dict(vars(self))
+
+        # The transactions of stores written before SSHDTransaction are dicts
+        # until they are converted, with their states, and are left as they
+        # are. Those in the sqlite store backend are not pickled here.
+
+        if isinstance(self.transactions, dict) and not self.states:
+            state['transactions'] = pack_transactions(self.transactions)
+
+        return state
+
+    def __setstate__(self, state: dict):
+        if isinstance(state.get('transactions'), tuple):
+            state['transactions'] = unpack_transactions(state['transactions'])
+        vars(self).update(state)
+
 
 class SSHD(Module):
 
     # GlobalConfig.add(SSHDConfig)
 
+    appnames = {'sshd'}
+
+    store_timestamps = {
+        'transactions': SessionTracker.payload_timestamp,
+        'lockout_hosts': SessionTracker.payload_timestamp,
+        'host_store': SlidingWindowCounter.last_seen}
+
     def __init__(self, module_name: str):
 
         super().__init__(module_name)
@@ -140,12 +360,21 @@ class SSHD(Module):
         self.identifier = 'sshd_logins'
         self.model = SSHDStore
         self.address_store = None
+        self.sessions = None
+        self.lockouts = None
+        self.top_addresses = None
+        self.top_users = None
+        self.classifier = self.build_classifier()
 
         self.add_config(SSHDConfig)
 
         self.expiry_seconds = None
         self.failure_limit = None
         self.max_transaction_age = None
+        self.max_tracked_hosts = None
+        self.lockout_cooldown = None
+        self.top_capacity = None
+        self.top_reported = None
 
     def initialize(self):
 
@@ -154,30 +383,27 @@ class SSHD(Module):
         self.expiry_seconds = self.get_config('login_failure_window')
         self.failure_limit = self.get_config('login_failure_limit')
         self.max_transaction_age = self.get_config('max_transaction_age')
+        self.max_tracked_hosts = self.get_config('max_tracked_hosts')
+        self.lockout_cooldown = self.get_config('lockout_cooldown')
+        self.top_capacity = self.get_config('top_capacity')
+        self.top_reported = self.get_config('top_reported')
 
     def maintenance(self):
         """ perform module maintenance
 
         Gaps in logs can result in transactions sticking around forever.
-        This code removes old transactions from the store.
+        This code removes old transactions from the store. The session
+        tracker only looks at the ones that have expired.
 
         """
 
-        total_transactions = 0
-        expired_transactions = 0
-
-        now = datetime.now()
+        # Until the store is loaded, there is nothing to expire
 
-        for transaction in list(self.store.transactions.keys()):
-            total_transactions += 1
-            expires_on = (self.store.transactions[transaction]['timestamp'] +
-                          timedelta(minutes=self.max_transaction_age))
+        if self.sessions is None:
+            return
 
-            if now > expires_on:
-                expired_transactions += 1
-                self.store.expired += 1
-                self._clear_state(transaction)
-                self.log.debug(f'Expired transaction {transaction}')
+        total_transactions = len(self.sessions)
+        expired_transactions = self.sessions.sweep(self.clock.now())
 
         if expired_transactions > 0:
             self.log.info(f'Expired {expired_transactions} transactions out'
@@ -186,12 +412,101 @@ class SSHD(Module):
             # todo: Evaluate sending an event with details of all expired
             #  transactions.
 
-    def timer_handler_hour(self, now):
+    def _expire_transaction(self, identifier, state, transaction):
+        self.store.expired += 1
+        self.log.debug(f'Expired transaction {identifier}')
+
+    def register_timers(self, scheduler):
+        scheduler.every(3600, self.hourly_maintenance)
+        scheduler.daily(0, 0, self.nightly_maintenance)
+        scheduler.every(max(self.expiry_seconds, 60), self.evict_hosts)
+        if self.lockout_cooldown > 0:
+            scheduler.every(min(self.lockout_cooldown, 60), self.end_lockouts)
+
+    def evict_hosts(self, now):
+        """Forgets the hosts with no login failures within the window"""
+
+        # Until the store is loaded, there is nothing to evict
+
+        if self.address_store is None:
+            return
+
+        evicted = self.address_store.evict(now)
+        if evicted:
+            self.log.debug(f'Forgot {evicted} host(s) with no recent login '
+                           f'failures')
+
+    def end_lockouts(self, now):
+        """Ends the lockout cooldowns that are over"""
+
+        # Until the store is loaded, there is nothing to end
+
+        if self.lockouts is None:
+            return
+
+        self.lockouts.sweep(now)
+
+    def _end_lockout(self, host, state, lockout):
+        if lockout.suppressed == 0:
+            return
+
+        self.log.debug(f'Lockout cooldown for {host} ended, '
+                       f'{lockout.suppressed} attempt(s) suppressed')
+        data = {
+            'host': host,
+            'suppressed': lockout.suppressed,
+            'start': lockout.timestamp,
+            'finish': lockout.last
+        }
+        self.dispatch_event(SSHDAttemptsSuppressed(data))
+
+    def count_failure(self, host, timestamp):
+        """Counts a failed login from a remote address
+
+        Called with keyed_call, so with shards, the failures from an address
+        are counted by one worker, whichever hosts they were on. timestamp is
+        the time of the record, so the failure window does not depend on when
+        the records arrive. The lockout cooldown follows the clock.
+
+        """
+
+        failures = self.address_store.add(host, timestamp)
+        self.log.debug(f"{failures} failures for host {host}")
+        if failures >= self.failure_limit:
+            self.lockout(host, self.clock.now())
+
+    def clear_failures(self, host):
+        """Forgets the failed logins from a remote address, with keyed_call"""
+
+        self.log.debug(f'Clearing any failed attempts for host {host}')
+        self.address_store.clear(host)
+
+    def lockout(self, host, now):
+        """Dispatches SSHDAttemptsExceeded for a host over the failure limit
+
+        It is dispatched once per lockout_cooldown for each host. The
+        attempts in between are only counted.
+
+        """
+
+        if self.lockout_cooldown > 0:
+            lockout = self.lockouts.get(host)
+            if lockout is not None:
+                lockout.suppressed += 1
+                lockout.last = now
+                self.store.suppressed += 1
+                return
+            self.lockouts.start(host, SSHDLockout(), now=now)
+
+        self.dispatch_event(SSHDAttemptsExceeded({'host': host}))
+        self.store.lockouts += 1
+
+    def hourly_maintenance(self, now):
         self.log.debug(f'Running scheduled maintenance (Now='
                        f'{format_timestamp(now)})')
         self.maintenance()
 
-    def timer_handler_0_0(self, now):
+    def nightly_maintenance(self, now):
         self.log.info(f'Running nightly maintenance '
                       f'(Now={format_timestamp(now)})')
         self.statistics(reset=True)
@@ -199,14 +514,110 @@ class SSHD(Module):
     def post_init_store(self):
         self.log.debug(
             'post_init_store: Initializing host counter from persistence store')
-        self.address_store = CountOverTime(
-            self.expiry_seconds, self.store.host_store)
+        self.address_store = SlidingWindowCounter(
+            self.expiry_seconds, self.store.host_store, self.clock,
+            self.max_tracked_hosts)
+
+        if self.store.states:
+            self.convert_transactions()
+
+        self.sessions = SessionTracker(
+            self.max_transaction_age * 60, None, self.store.transactions,
+            self._expire_transaction, self.clock)
+
+        # Stores written by earlier versions don't have the newer fields
+
+        for name in ['lockout_hosts', 'top_addresses', 'top_users']:
+            if not hasattr(self.store, name):
+                setattr(self.store, name, {})
+
+        self.lockouts = SessionTracker(
+            self.lockout_cooldown, None, self.store.lockout_hosts,
+            self._end_lockout, self.clock)
+        self.top_addresses = SpaceSaving(
+            self.top_capacity, self.store.top_addresses)
+        self.top_users = SpaceSaving(self.top_capacity, self.store.top_users)
+
+    def convert_transactions(self):
+        """Converts the transaction dicts of a store written before
+        SSHDTransaction, with their states, to SSHDTransactions"""
+
+        (states, transactions) = (self.store.states, self.store.transactions)
+        for (identifier, state) in list(states.items()):
+            payload = transactions.get(identifier)
+            if isinstance(payload, dict):
+                transactions[identifier] = SSHDTransaction.from_dict(
+                    state, payload)
+            del states[identifier]
+        self.log.info(f'Converted {len(transactions)} transaction(s) to '
+                      f'SSHDTransaction')
+
+    def partition_store(self, store, count, shard_of):
+        """Splits the transactions by the hostname in their identifier
+
+        The failures and lockouts per remote address are split by the
+        address, since they are counted with keyed_call. The statistics stay
+        with the first shard.
+
+        """
+
+        stores = [replace(store, states={}, transactions={}, host_store={},
+                          lockout_hosts={})]
+        stores += [self.model() for _ in range(count - 1)]
+
+        for addr, timestamps in store.host_store.items():
+            stores[shard_of(addr)].host_store[addr] = timestamps
+
+        for addr, lockout in store.lockout_hosts.items():
+            stores[shard_of(addr)].lockout_hosts[addr] = lockout
+
+        for identifier, state in store.states.items():
+            hostname = identifier.rsplit('.', 1)[0]
+            stores[shard_of(hostname)].states[identifier] = state
+
+        for identifier, transaction in store.transactions.items():
+            hostname = identifier.rsplit('.', 1)[0]
+            stores[shard_of(hostname)].transactions[identifier] = transaction
+
+        return stores
+
+    def merge_stores(self, stores):
+
+        merged = super().merge_stores(stores)
+
+        # Each remote address is in the host_store and lockout_hosts of one
+        # shard only, so updating the dicts merges them. The heavy hitter
+        # counts of an address or user are split between the shards.
+
+        merged.top_addresses = SpaceSaving.merge(
+            [store.top_addresses for store in stores], self.top_capacity)
+        merged.top_users = SpaceSaving.merge(
+            [store.top_users for store in stores], self.top_capacity)
+
+        return merged
 
     def clear_statistics(self):
         self.store.login_sessions = 0
         self.store.denied = 0
         self.store.lockouts = 0
+        self.store.suppressed = 0
         self.store.expired = 0
+        self.top_addresses.clear()
+        self.top_users.clear()
+
+    def top(self, counters: dict) -> str:
+        """Formats the items with the most failed logins, for SSHDStats
+
+        The counters are read from the store, which is the merged store of
+        the shards when they are in worker processes. They are only read:
+        they are counted, and trimmed, by process_record.
+
+        """
+
+        top = SpaceSaving.top_of(counters, self.top_reported)
+        if not top:
+            return 'none'
+        return ', '.join(f'{item} ({count})' for (item, count) in top)
 
     def statistics(self, reset=False):
 
@@ -214,38 +625,17 @@ class SSHD(Module):
             'login_sessions': self.store.login_sessions,
             'denied': self.store.denied,
             'lockouts': self.store.lockouts,
+            'suppressed': self.store.suppressed,
             'expired': self.store.expired,
-            'partial': len(self.store.transactions)
-
+            'partial': len(self.store.transactions),
+            'top_addresses': self.top(self.store.top_addresses),
+            'top_users': self.top(self.store.top_users)
         }
         self.dispatch_event(SSHDStats(data))
 
         if reset:
             self.clear_statistics()
 
-    def _has_state(self, identifier):
-        if self.store.states.get(identifier) is not None:
-            return True
-        return False
-
-    def _set_state(self, identifier, state):
-        self.store.states[identifier] = state
-        return state
-
-    def _get_state(self, identifier):
-
-        state = self.store.states.get(identifier)
-        if state is None:
-            return self._set_state(identifier, 0)
-        return state
-
-    def _clear_state(self, identifier):
-
-        if self.store.states.get(identifier):
-            del self.store.states[identifier]
-        if self.store.transactions.get(identifier):
-            del self.store.transactions[identifier]
-
     @staticmethod
     def tostring(record):
         return (f'{record.timestamp} {record.hostname} {record.instance} '
@@ -253,154 +643,88 @@ class SSHD(Module):
                 f'{record.detail}')
 
     @staticmethod
-    def detect_invalid_user(string):
-        m = re.match(r'Invalid user (\S+) from (\S+) port (\d+)', string)
-        if m:
-            return {
-                'user': m.group(1),
-                'addr': m.group(2),
-                'port': m.group(3),
-            }
-        return None
-
-    @staticmethod
-    def detect_passwordfailure(string):
-
-        m = re.match(r'Failed password for (\S+) from (\S+) port (\S+)', string)
-        if not m:
-            m = re.match(r'Failed password for invalid user (\S+) from (\S+) '
-                         r'port (\S+)', string)
-        if m:
-            return {
-                'user': m.group(1),
-                'addr': m.group(2),
-                'port': m.group(3),
-            }
-
-        return None
-
-    # @staticmethod
-    def detect_authfailure(self, string):
-        m = re.match(r'.+authentication failure;\s+(.+)\s*', string)
-        if m:
-            prop_str = m.group(1).strip()
-            self.log.debug(f'detect_authfailure: prop_str={prop_str}')
-            props = dict(x.split('=') for x in re.split(' +', prop_str))
-            if len(props) > 0:
-                return props
-
-        return None
-
-    @staticmethod
-    def detect_accepted(string):
-
-        # self.log.debug(f'detect_accepted: string=[{string}]')
-
-        m = re.match(r'Accepted publickey for (\S+) from (\S+) port (\S+) '
-                     r'ssh2: RSA (\S+)', string)
-        if m:
-            return {
-                'auth': 'rsa',
-                'user': m.group(1),
-                'addr': m.group(2),
-                'port': m.group(3),
-                'key': m.group(4)
-            }
-
-        m = re.match(r'Accepted password for (\S+) from (\S+) port (\S+)',
-                     string)
-
-        if m:
-            return {
-                'auth': 'password',
-                'user': m.group(1),
-                'addr': m.group(2),
-                'port': m.group(3),
-                'key': None
-            }
-
-        return None
-    
-    @staticmethod
-    def detect_open(string):
-
-        m = re.match(r'pam_unix\(sshd:session\): session opened for user (\S+) '
-                     r'by (\S+)', string)
-
-        if m:
-            return {
-                'user': m.group(1),
-                'by': m.group(2)
-            }
-        
-        return None
-
-    @staticmethod
-    def detect_close(string):
-
-        if string.startswith('Connection closed'):
-            return {}
-
-        if string.startswith('pam_unix(sshd:session): session closed'):
-            return {}
-
-        return None
+    def build_classifier() -> MessageClassifier:
+        """Builds the classifier for sshd messages, once per module instance"""
+
+        classifier = MessageClassifier()
+
+        classifier.add(
+            'accepted', 'Accepted publickey for ',
+            r'Accepted publickey for (?P<user>\S+) from (?P<addr>\S+) '
+            r'port (?P<port>\S+) ssh2: RSA (?P<key>\S+)', auth='rsa')
+        classifier.add(
+            'accepted', 'Accepted password for ',
+            r'Accepted password for (?P<user>\S+) from (?P<addr>\S+) '
+            r'port (?P<port>\S+)', auth='password', key=None)
+        classifier.add(
+            'password_failure', 'Failed password for ',
+            r'Failed password for (?P<user>\S+) from (?P<addr>\S+) '
+            r'port (?P<port>\S+)')
+        classifier.add(
+            'password_failure', 'Failed password for invalid user ',
+            r'Failed password for invalid user (?P<user>\S+) from '
+            r'(?P<addr>\S+) port (?P<port>\S+)')
+        classifier.add(
+            'invalid_user', 'Invalid user ',
+            r'Invalid user (?P<user>\S+) from (?P<addr>\S+) '
+            r'port (?P<port>\d+)')
+        classifier.add(
+            'open', 'pam_unix(sshd:session): session opened for user ',
+            r'pam_unix\(sshd:session\): session opened for user '
+            r'(?P<user>\S+) by (?P<by>\S+)')
+        classifier.add('close', 'pam_unix(sshd:session): session closed')
+        classifier.add('close', 'Connection closed')
+
+        # The PAM module name varies, so authentication failures are found by
+        # a substring
+
+        classifier.add_substring(
+            'auth_failure', 'authentication failure;',
+            r'.+authentication failure;\s+(?P<properties>.+)\s*')
+
+        return classifier
+
+    def auth_failure_properties(self, properties: str) -> dict:
+        """Splits the key=value properties of a PAM authentication failure"""
+
+        self.log.debug(f'auth_failure_properties: properties={properties}')
+        return dict(item.partition('=')[::2] for item in properties.split())
 
     def process_record(self, record):
 
-        if record.appname.lower() != 'sshd':
-            return
-
         identifier = f'{record.hostname}.{record.proc_id}'
 
-        if not self._has_state(identifier):
+        # The message is classified once, by its prefix
+
+        (kind, props) = self.classifier.classify(record.detail)
+
+        if identifier not in self.sessions:
 
-            props = self.detect_accepted(record.detail)
-            if props:
-                self._set_state(identifier, 0)
+            if kind == 'accepted':
                 addr = props.get('addr')
-                self.store.transactions[identifier] = {
-                    'timestamp': datetime.now(),
-                    'auth': props.get('auth'),
-                    'user': props.get('user'),
-                    'addr': addr,
-                    'port': props.get('port'),
-                    'key': props.get('key'),
-                    'failures': 0
-                }
-                self.log.debug(f'Clearing any failed attempts for host {addr}')
-                self.address_store.clear(addr)
+                self.sessions.start(identifier, SSHDTransaction.create(
+                    auth=props.get('auth'),
+                    user=props.get('user'),
+                    addr=addr,
+                    port=props.get('port'),
+                    key=props.get('key')))
+                self.keyed_call(addr, 'clear_failures', addr)
                 self.log.debug(f'Authentication succeeded for {props.get("user")}')
                 return
 
-            props = self.detect_authfailure(record.detail)
-            if props is not None:
-                self._set_state(identifier, 0)
-
-                self.store.transactions[identifier] = {
-                    'timestamp': datetime.now(),
-                    'auth': None,
-                    'user': props.get('user'),
-                    'addr': props.get('rhost'),
-                    'port': None,
-                    'key': None,
-                    'failures': 0
-                }
+            if kind == 'auth_failure':
+                props = self.auth_failure_properties(props['properties'])
+                self.sessions.start(identifier, SSHDTransaction.create(
+                    user=props.get('user'),
+                    addr=props.get('rhost')))
                 self.log.debug(f'Authentication failed for {props.get("user")}')
                 return
 
-            props = self.detect_invalid_user(record.detail)
-            if props is not None:
-                self._set_state(identifier, 0)
-                self.store.transactions[identifier] = {
-                    'timestamp': datetime.now(),
-                    'auth': None,
-                    'user': props.get('user'),
-                    'addr': props.get('addr'),
-                    'port': props.get('addr'),
-                    'key': None,
-                    'failures': 0
-                }
+            if kind == 'invalid_user':
+                self.sessions.start(identifier, SSHDTransaction.create(
+                    user=props.get('user'),
+                    addr=props.get('addr'),
+                    port=props.get('addr')))
                 self.log.debug(f'Invalid user {props.get("user")}')
                 return
 
@@ -408,65 +732,49 @@ class SSHD(Module):
 
             return True
 
-        state = self._get_state(identifier)
-        trans = self.store.transactions[identifier]
+        state = self.sessions.state(identifier)
+        trans = self.sessions.get(identifier)
 
         if state == 0:
-            props = self.detect_passwordfailure(record.detail)
-            if props is not None:
+            if kind == 'password_failure':
                 host = props.get('addr')
-                trans['failures'] += 1
-                failures = self.address_store.add(host, record.timestamp)
-                self.log.debug(f"{failures} failures for host {host}")
-                if failures >= self.failure_limit:
-                    # Dispatch SSHDAttemptsExceeded
-                    data = { 'host': props.get('addr')
-                    }
-                    self.dispatch_event(
-                        SSHDAttemptsExceeded(data))
-                    self.store.lockouts += 1
+                trans.failures += 1
+                self.top_addresses.add(host)
+                self.top_users.add(props.get('user'))
+                self.keyed_call(host, 'count_failure', host,
+                                record.timestamp or self.clock.now())
                 return
-            props = self.detect_open(record.detail)
-            if props is not None:
-                trans['start'] = record.timestamp
-                self._set_state(identifier, 1)
+            if kind == 'open':
+                trans.start = record.timestamp
+                self.sessions.set_state(identifier, 1)
                 return
-            props = self.detect_accepted(record.detail)
-            if props is not None:
+            if kind == 'accepted':
                 host = props['addr']
                 for field_name in ['auth', 'user', 'addr', 'port', 'key']:
-                    trans[field_name] = props[field_name]
-                self.log.debug(f'Clearing any failed attempts for host {host}')
-                self.address_store.clear(host)
+                    setattr(trans, field_name, _intern(props[field_name]))
+                self.keyed_call(host, 'clear_failures', host)
 
-            props = self.detect_close(record.detail)
-            if props is not None:
+            if kind == 'close':
                 self.store.denied += 1
                 # Dispatch SSHDLoginFailed
-                data =  {}
-                for key in ['user', 'addr', 'port', 'failures']:
-                    data[key] = trans[key]
+                data = trans.fields(['user', 'addr', 'port', 'failures'])
                 self.dispatch_event(
                     SSHDLoginFailed(data))
                 return
             self.log.debug(f'Skipping State 0 record: {str(record)}')
         elif state == 1:
-            props = self.detect_close(record.detail)
-            if props is not None:
-                trans['finish'] = record.timestamp
+            if kind == 'close':
+                trans.finish = record.timestamp
                 self.store.login_sessions += 1
                 # Dispatch SSHDLoginSucceeded
-                data = {}
-                for key in [
+                data = trans.fields([
                     'auth', 'user', 'addr', 'port', 'key', 'failures',
-                        'start', 'finish']:
-                    data[key] = trans[key]
+                    'start', 'finish'])
 
-                data['duration'] = str(trans['finish'] - trans['start'])
+                data['duration'] = str(trans.finish - trans.start)
                 self.dispatch_event(
                     SSHDLoginSucceeded(data))
 
-                del self.store.transactions[identifier]
-                del self.store.states[identifier]
+                self.sessions.end(identifier)
                 return
             self.log.debug(f'Skipping State 1 record: {str(record)}')
@@ -55,6 +55,9 @@ class TransmissionStore:
 
 
 class Transmission(Module):
+
+    appnames = {'transmission-daemon'}
+
     def __init__(self, module_name: str):
 
         super().__init__(module_name)
@@ -105,9 +108,6 @@ class Transmission(Module):
 
     def process_record(self, record):
 
-        if record.appname.lower() != 'transmission-daemon':
-            return
-
         self.log.debug(f'Checking transmission record: {record.detail}')
         torrent_name = self.detect_complete(record.detail)
         if torrent_name:
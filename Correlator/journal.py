@@ -0,0 +1,304 @@
+"""Write-ahead journal for the persistence store
+
+Rather than pickling the whole store every time it is saved, the changes
+made to it are appended to a journal every few seconds. The journal is
+replayed on top of the last full snapshot of the store when it is loaded.
+
+The journal is written in numbered segments. A new segment is started each
+time a snapshot of the store is taken, and the older segments are removed
+once the snapshot has been written (compaction).
+
+Changes are tracked per key for the dict fields of the module stores, which
+is where the bulk of the data is. Every other field is small, and is written
+to each journal entry whole. Dict fields kept in SQLite by the sqlite store
+backend are left out: they are made durable by their own commits.
+
+"""
+
+import glob
+import logging
+import os
+import pickle
+
+from Correlator.sqlite_store import SQLiteDict
+
+log = logging.getLogger(__name__)
+
+
+class JournalDict(dict):
+
+    """ dict that remembers which keys were changed
+
+    Keys that are read are counted as changed too, since the value may be
+    modified in place (for example store.transactions[identifier].failures
+    += 1). Checking for a key with `in` is not.
+
+    It pickles as a plain dict.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = set()
+        self.deleted = set()
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    def _changed(self, key):
+        self.dirty.add(key)
+        self.deleted.discard(key)
+
+    def _removed(self, key):
+        self.dirty.discard(key)
+        self.deleted.add(key)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self._changed(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            self._changed(key)
+        return super().get(key, default)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._removed(key)
+
+    def setdefault(self, key, default=None):
+        self._changed(key)
+        return super().setdefault(key, default)
+
+    def pop(self, key, *args):
+        if key in self:
+            self._removed(key)
+        return super().pop(key, *args)
+
+    def popitem(self):
+        (key, value) = super().popitem()
+        self._removed(key)
+        return key, value
+
+    def update(self, *args, **kwargs):
+        for (key, value) in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        for key in self:
+            self._removed(key)
+        super().clear()
+
+    def take_changes(self) -> tuple[dict, list]:
+        """Returns the changed keys and values, and the deleted keys
+
+        The changes are forgotten.
+
+        """
+
+        changes = ({key: dict.__getitem__(self, key) for key in self.dirty},
+                   list(self.deleted))
+        self.dirty = set()
+        self.deleted = set()
+        return changes
+
+
+class StoreJournal:
+
+    """ Append-only journal of changes to the persistence store
+
+    Each entry is a pickle of its sequence number and the changes to every
+    module store since the last entry. A snapshot of the store records the
+    sequence number it includes, so entries already in the snapshot are
+    skipped when the journal is replayed. An entry that was only partly
+    written (because of a crash) ends the replay of its segment.
+
+    Segments are files named after the journal, followed by their number.
+    Entries are always appended to a new segment after a replay, never to
+    one that may end with a partly written entry.
+
+    Args:
+        file_name: Name of the journal, without the segment number
+
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.sequence = 0
+        self.segment = max(self.segments(), default=0) + 1
+        self._file = None
+        self._fields = None
+
+    def segments(self) -> list[int]:
+        """Returns the numbers of the segments on disk, in order"""
+
+        numbers = []
+        for name in glob.glob(glob.escape(self.file_name) + '.*'):
+            suffix = name[len(self.file_name) + 1:]
+            if suffix.isdigit():
+                numbers.append(int(suffix))
+
+        return sorted(numbers)
+
+    def segment_name(self, segment: int) -> str:
+        return f'{self.file_name}.{segment}'
+
+    @staticmethod
+    def track(store):
+        """Replaces the dict fields of a module store with JournalDicts"""
+
+        for (name, value) in vars(store).items():
+            if type(value) is dict:
+                setattr(store, name, JournalDict(value))
+
+    @staticmethod
+    def untrack(store):
+        """Replaces the JournalDict fields of a module store with dicts
+
+        For copies of the store whose changes are not journaled, which would
+        otherwise remember every key they change, since nothing takes them.
+
+        """
+
+        for (name, value) in vars(store).items():
+            if isinstance(value, JournalDict):
+                setattr(store, name, dict(value))
+
+    @staticmethod
+    def _changes(store) -> dict:
+        fields = {}
+        dicts = {}
+
+        for (name, value) in vars(store).items():
+            if isinstance(value, JournalDict):
+                (changed, deleted) = value.take_changes()
+                if changed or deleted:
+                    dicts[name] = (changed, deleted)
+            elif not isinstance(value, SQLiteDict):
+                fields[name] = value
+
+        return {'fields': fields, 'dicts': dicts}
+
+    def append(self, full_store: dict):
+        """Writes the changes made to the store since the last entry
+
+        Nothing is written if nothing has changed.
+
+        """
+
+        changes = {name: self._changes(store)
+                   for (name, store) in full_store.items()}
+
+        fields = pickle.dumps(
+            {name: module_changes['fields']
+             for (name, module_changes) in changes.items()})
+        if fields == self._fields and not any(
+                module_changes['dicts'] for module_changes in changes.values()):
+            return
+
+        self._fields = fields
+        self.sequence += 1
+        entry = (self.sequence, changes)
+
+        if self._file is None:
+            self._file = open(self.segment_name(self.segment), 'ab')
+
+        pickle.dump(entry, self._file, pickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def replay(self, full_store: dict, sequence: int,
+               deferred: dict = None) -> int:
+        """Applies the entries after sequence, from every segment, to the store
+
+        Changes to module stores that are not in full_store (because they
+        have not been loaded yet) are added to the list for the module in
+        deferred, for apply_module once they are.
+
+        Returns:
+            The number of entries applied.
+
+        """
+
+        self.sequence = sequence
+        applied = 0
+
+        for segment in self.segments():
+            name = self.segment_name(segment)
+            with open(name, 'rb') as input_file:
+                while True:
+                    try:
+                        (entry_sequence, changes) = pickle.load(input_file)
+                    except EOFError:
+                        break
+                    except (pickle.UnpicklingError, ValueError,
+                            TypeError) as e:
+                        log.warning(f'Journal segment {name} ends with an '
+                                    f'incomplete entry: {e}')
+                        break
+
+                    if entry_sequence <= self.sequence:
+                        continue
+
+                    self._apply(full_store, changes, deferred)
+                    self.sequence = entry_sequence
+                    applied += 1
+
+        return applied
+
+    def _apply(self, full_store: dict, changes: dict, deferred: dict = None):
+        for (name, module_changes) in changes.items():
+            store = full_store.get(name)
+            if store is not None:
+                self.apply_module(store, module_changes)
+            elif deferred is not None:
+                deferred.setdefault(name, []).append(module_changes)
+
+    @staticmethod
+    def apply_module(store, module_changes: dict):
+        """Applies the changes to one module store from a journal entry"""
+
+        for (field, value) in module_changes['fields'].items():
+            setattr(store, field, value)
+        for (field, (changed, deleted)) in module_changes['dicts'].items():
+            values = getattr(store, field)
+            values.update(changed)
+            for key in deleted:
+                values.pop(key, None)
+
+    def rotate(self, full_store: dict) -> int:
+        """Starts a new segment, as a snapshot of the store is taken
+
+        Changes tracked until now are in the snapshot, so they are forgotten.
+
+        Returns:
+            The number of the new segment. The segments before it can be
+            removed once the snapshot has been written.
+
+        """
+
+        for store in full_store.values():
+            for value in vars(store).values():
+                if isinstance(value, JournalDict):
+                    value.take_changes()
+
+        self._fields = None
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        self.segment += 1
+        return self.segment
+
+    def remove_segments(self, before: int):
+        """Removes the segments numbered before a segment"""
+
+        for segment in self.segments():
+            if segment < before:
+                os.remove(self.segment_name(segment))
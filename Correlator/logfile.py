@@ -2,7 +2,8 @@ import logging
 import re
 
 from Correlator.Event.core import (EventProcessor, StatsEvent)
-from Correlator.util import ParserError, Module, format_timestamp
+from Correlator.util import (ParserError, Module, ModuleRouter,
+                             format_timestamp)
 
 log = logging.getLogger(__name__)
 
@@ -90,6 +91,7 @@ class LogfileProcessor:
         self.end = None
 
         self.modules = modules
+        self.router = ModuleRouter(modules)
         self.log_record = log_record
 
         # No persistence with logfiles
@@ -139,7 +141,8 @@ class LogfileProcessor:
                             result.record.timestamp > self.end):
                         self.end = result.record.timestamp
 
-                    for module in list(self.modules):
+                    appname = getattr(result.record, 'appname', None)
+                    for module in self.router.route(appname):
                         module.process_record(result.record)
 
     def log_stats(self, processor: EventProcessor):
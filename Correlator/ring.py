@@ -0,0 +1,167 @@
+"""Shared memory ring buffer of records
+
+A queue of byte strings in a multiprocessing.shared_memory block, with a
+single producer process and a single consumer process. The producer never
+waits: if there is no room for a record, it is counted as an overflow and
+discarded.
+
+The block starts with a header of 64 bit counters, followed by the ring. Each
+record is stored as a 32 bit length followed by the record. A record is never
+split across the end of the ring: the rest of the ring is skipped instead,
+marked with a length of RING_WRAP if there is room for one.
+
+The head (bytes written) is only changed by the producer, and the tail (bytes
+read) only by the consumer. Each is stored after the records it covers have
+been written or read.
+
+"""
+
+import struct
+from multiprocessing import shared_memory
+
+RING_HEAD = 0
+RING_TAIL = 8
+RING_HIGH_WATER = 16
+RING_OVERFLOWS = 24
+RING_DROPPED = 32
+RING_HEADER_SIZE = 40
+
+RING_WRAP = 0xFFFFFFFF
+
+_counter = struct.Struct('=Q')
+_length = struct.Struct('=I')
+
+
+class RecordRing:
+
+    """ Single producer, single consumer ring buffer in shared memory
+
+    Create it before forking the producer process. The producer calls put,
+    and the consumer calls records.
+
+    Args:
+        size: Size of the ring in bytes
+
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=RING_HEADER_SIZE + size)
+        self.header = self.memory.buf[0:RING_HEADER_SIZE]
+        self.data = self.memory.buf[RING_HEADER_SIZE:RING_HEADER_SIZE + size]
+        self.header[:] = bytes(RING_HEADER_SIZE)
+
+        self._head = 0
+        self._tail = 0
+
+    def _get(self, offset: int) -> int:
+        return _counter.unpack_from(self.header, offset)[0]
+
+    def _set(self, offset: int, value: int):
+        _counter.pack_into(self.header, offset, value)
+
+    @property
+    def used(self) -> int:
+        """Number of bytes in the ring that have not been read yet"""
+        return self._get(RING_HEAD) - self._get(RING_TAIL)
+
+    @property
+    def high_water(self) -> int:
+        """Most bytes there have been in the ring at one time"""
+        return self._get(RING_HIGH_WATER)
+
+    @property
+    def overflows(self) -> int:
+        """Number of records discarded because the ring was full"""
+        return self._get(RING_OVERFLOWS)
+
+    @property
+    def dropped(self) -> int:
+        """Records dropped by the producer for its own reasons"""
+        return self._get(RING_DROPPED)
+
+    @dropped.setter
+    def dropped(self, value: int):
+        self._set(RING_DROPPED, value)
+
+    def put(self, record: bytes) -> bool:
+        """Adds a record to the ring. Producer only.
+
+        Returns:
+            False if there was no room for the record.
+
+        """
+
+        head = self._head
+        offset = head % self.size
+        needed = _length.size + len(record)
+
+        # Skip the rest of the ring if the record doesn't fit before its end
+
+        skip = self.size - offset if needed > self.size - offset else 0
+
+        used = head - self._get(RING_TAIL)
+        if used + skip + needed > self.size:
+            self._set(RING_OVERFLOWS, self._get(RING_OVERFLOWS) + 1)
+            return False
+
+        if skip:
+            if skip >= _length.size:
+                _length.pack_into(self.data, offset, RING_WRAP)
+            head += skip
+            offset = 0
+
+        _length.pack_into(self.data, offset, len(record))
+        self.data[offset + _length.size:offset + needed] = record
+
+        head += needed
+        self._head = head
+        self._set(RING_HEAD, head)
+
+        if used + skip + needed > self._get(RING_HIGH_WATER):
+            self._set(RING_HIGH_WATER, used + skip + needed)
+
+        return True
+
+    def records(self):
+        """Yields every record in the ring, removing it. Consumer only."""
+
+        tail = self._tail
+        head = self._get(RING_HEAD)
+
+        while tail != head:
+            offset = tail % self.size
+            remaining = self.size - offset
+
+            if remaining < _length.size:
+                tail += remaining
+                continue
+
+            length = _length.unpack_from(self.data, offset)[0]
+            if length == RING_WRAP:
+                tail += remaining
+                continue
+
+            start = offset + _length.size
+            record = bytes(self.data[start:start + length])
+
+            tail += _length.size + length
+            self._tail = tail
+            self._set(RING_TAIL, tail)
+
+            yield record
+
+            if tail == head:
+                head = self._get(RING_HEAD)
+
+        self._tail = tail
+        self._set(RING_TAIL, tail)
+
+    def close(self):
+        """Releases and removes the shared memory. Creating process only."""
+
+        self.header.release()
+        self.data.release()
+        self.memory.close()
+        self.memory.unlink()
@@ -0,0 +1,458 @@
+"""Hostname sharded syslog server
+
+Runs the modules in a number of worker processes. The process that receives
+the records sends each one to a worker, chosen by the hostname in the record
+header, so all records from a host are processed by the same worker, in order.
+
+"""
+
+import glob
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import signal
+import time
+import zlib
+from contextlib import contextmanager
+from typing import BinaryIO
+
+from Correlator.journal import StoreJournal
+from Correlator.syslog import SyslogServer, raw_header_fields
+from Correlator.util import Scheduler, WallClock
+
+log = logging.getLogger(__name__)
+
+SHARD_BATCH_SIZE = 256
+SHARD_REPLY_TIMEOUT = 5
+SHARD_PART_POLL = 0.1
+
+
+def shard_of(hostname: str | bytes, shards: int) -> int:
+    """Returns the shard that records from a hostname are processed by"""
+
+    if isinstance(hostname, str):
+        hostname = hostname.encode('utf-8')
+    return zlib.crc32(hostname) % shards
+
+
+class ShardedSyslogServer(SyslogServer):
+
+    """ SyslogServer that processes records in worker processes
+
+    Each worker has its own copy of the modules, and its own part of the
+    persistence store, made by Module.partition_store. The parts are merged
+    back together with Module.merge_stores whenever the store is saved, and
+    when the workers are stopped, so statistics see the whole store.
+
+    For a background save, each worker forks a child that writes its part to
+    a file of its own, and the save process forked by the receiving process
+    merges the parts into the store file. Neither the workers nor the
+    receiving process wait for the stores to be pickled. Saves in the
+    foreground, at shutdown, collect the stores through the queues.
+
+    Records are sent to the workers in batches. A batch is sent when it is
+    full, and after every block of data received.
+
+    Module.keyed_call calls for state kept by another key than the hostname
+    are sent by the worker that processed the record to the queue of the
+    worker that owns the key. Before a worker hands over its store, it
+    exchanges a marker with every other worker, so the calls sent to it
+    before then have all been made.
+
+    Args:
+        shards: Number of worker processes
+
+    The other arguments are the same as for SyslogServer.
+
+    """
+
+    def __init__(self, *args, shards: int = 2, **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        self.shards = shards
+        self.shard_index = None
+        self.workers = []
+        self.queues = []
+        self.replies = None
+        self.batches = [[] for _ in range(shards)]
+        self.markers = 0
+        self.save_generation = 0
+        self._parts_pending = False
+
+        # The changes are made in the workers, and tracked there, so there
+        # is nothing to append to the journal here. It is kept to apply the
+        # entries left by an earlier run, and to remove them once saved.
+
+        if self.journal is not None:
+            log.warning(f'The store journal is not supported with sharded '
+                        f'processing. The store is only saved every '
+                        f'{self.save_store_interval} minute(s).')
+
+    def start_workers(self):
+
+        context = multiprocessing.get_context('fork')
+        self.replies = context.Queue()
+
+        parts = {
+            module.module_name: module.partition_store(
+                module.store, self.shards,
+                lambda hostname: shard_of(hostname, self.shards))
+            for module in self.modules}
+
+        # Every worker can send keyed calls to every other one, so the queues
+        # are all made before the first worker is forked
+
+        self.queues = [context.Queue() for _ in range(self.shards)]
+
+        for index in range(self.shards):
+            store = {name: stores[index] for (name, stores) in parts.items()}
+            worker = context.Process(
+                target=self._worker, args=(index, self.queues[index], store),
+                name=f'shard-{index}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        log.info(f'Started {self.shards} shard workers')
+
+    def stop_workers(self):
+
+        self._collect('stop')
+
+        for worker in self.workers:
+            worker.join()
+
+        self.workers = []
+        self.queues = []
+
+        log.info('Stopped shard workers')
+
+    @contextmanager
+    def _workers_running(self):
+        if self.workers:
+            yield
+            return
+
+        self.start_workers()
+        try:
+            yield
+        finally:
+            self.stop_workers()
+
+    def from_file(self, input_file: BinaryIO, output_file: BinaryIO = None):
+        with self._workers_running():
+            super().from_file(input_file, output_file)
+
+    def from_mmap(self, input_file: BinaryIO, output_file: BinaryIO = None):
+        with self._workers_running():
+            super().from_mmap(input_file, output_file)
+
+    def listen(self, output_file: BinaryIO = None):
+        with self._workers_running():
+            super().listen(output_file)
+
+    def save_store(self, background: bool = True):
+
+        if self.skip_save_store:
+            return
+
+        if not self.store_file or not self.workers:
+            super().save_store(background)
+            return
+
+        # The parts are only removed once no save is waiting for them
+
+        if not background:
+            self._reap_save(wait=True)
+            self._remove_parts()
+            self._collect('snapshot')
+        elif self._reap_save(wait=False):
+            self._remove_parts()
+            self._request_parts()
+
+        # The save process forked by save_store merges the parts (see
+        # _write_store)
+
+        try:
+            super().save_store(background)
+        finally:
+            self._parts_pending = False
+
+    def _part_name(self, index: int) -> str:
+        return f'{self.store_file}.shard{index}.{self.save_generation}'
+
+    def _remove_parts(self):
+        """Removes the parts left by saves that did not complete"""
+
+        for file_name in glob.glob(f'{glob.escape(self.store_file)}.shard*'):
+            os.remove(file_name)
+
+    def _request_parts(self):
+        """Asks every worker to write its part of the store"""
+
+        self._block_processed()
+        self.save_generation += 1
+
+        for (index, records) in enumerate(self.queues):
+            records.put(('save', self._part_name(index)))
+
+        self._parts_pending = True
+
+    def _write_store(self, sequence: int):
+
+        if self._parts_pending:
+            self._merge_parts()
+
+        super()._write_store(sequence)
+
+    def _merge_parts(self):
+        """Waits for the parts of the store the workers write, and merges them
+
+        Runs in the save process. A worker that fails to write its part
+        leaves a .failed file instead. If a part is not written before the
+        next save is due, the save is given up.
+
+        """
+
+        deadline = time.monotonic() + self.save_store_interval * 60
+        stores = []
+
+        for index in range(len(self.workers)):
+            file_name = self._part_name(index)
+            while not os.path.exists(file_name):
+                if os.path.exists(f'{file_name}.failed'):
+                    raise RuntimeError(f'Shard worker {index} failed to '
+                                       f'write its part of the store')
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Shard worker {index} did not write '
+                                       f'its part of the store')
+                time.sleep(SHARD_PART_POLL)
+
+            with open(file_name, 'rb') as input_file:
+                stores.append(pickle.load(input_file))
+            os.remove(file_name)
+
+        for module in self.modules:
+            self.full_store[module.module_name] = module.merge_stores(
+                [store[module.module_name] for store in stores])
+
+    def _save_part(self, file_name: str):
+        """Writes this worker's store to file_name, in a forked child
+
+        The part is written to a temporary file that then replaces file_name,
+        so the save process only reads complete parts. The worker reaps the
+        child from _tick.
+
+        """
+
+        # The previous part was merged, so its child is done or exiting
+
+        self._reap_save(wait=True)
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                with open(f'{file_name}.tmp', 'wb') as output_file:
+                    pickle.dump(self.full_store, output_file,
+                                pickle.HIGHEST_PROTOCOL)
+                    output_file.flush()
+                    os.fsync(output_file.fileno())
+                os.replace(f'{file_name}.tmp', file_name)
+                os._exit(0)
+            except BaseException as e:
+                log.error(f'Save store: Failed to write {file_name}')
+                log.exception(e)
+                open(f'{file_name}.failed', 'wb').close()
+                os._exit(1)
+
+        self._save_process = (pid, None)
+
+    def _append_journal(self):
+
+        # The changes are made in the workers (see __init__)
+
+        return
+
+    def _open_databases(self):
+
+        # An SQLite connection can't be used by the forked workers, so the
+        # stores are kept in memory
+
+        for module in self.modules:
+            if module.get_config('store_backend') != 'pickle':
+                log.warning(f'Module {module.module_name}: The '
+                            f'{module.get_config("store_backend")} store '
+                            f'backend is not supported with sharded '
+                            f'processing. Keeping the store in memory.')
+
+    def _worker(self, index, records: multiprocessing.Queue, store: dict):
+
+        # The receiving process shuts the workers down
+
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        self.shard_index = index
+        self.skip_save_store = True
+        self.full_store = store
+
+        # The workers run the module timers, and the receiving process saves
+        # the store
+
+        self.scheduler = Scheduler(self.clock)
+        self.store_scheduler = Scheduler(WallClock())
+
+        # The parent tracks the changes to its stores for the journal. Those
+        # made here are never journaled (see __init__)
+
+        for module in self.modules:
+            StoreJournal.untrack(store[module.module_name])
+            module.store = store[module.module_name]
+            module.key_router = self._route_key
+            module.post_init_store()
+            module.register_timers(self.scheduler)
+
+        while True:
+            try:
+                (kind, batch) = records.get(timeout=self._seconds_remaining())
+            except queue.Empty:
+                self._tick(self.clock.now())
+                continue
+
+            if kind == 'records':
+                for data in batch:
+                    SyslogServer._handle_record(self, data)
+                self._tick(self.clock.now())
+            elif kind == 'save':
+                self._exchange_markers(records)
+                self._save_part(batch)
+            elif not self._worker_message(kind, batch):
+                self._exchange_markers(records)
+                self.replies.put(
+                    (index, self.full_store, self.router.unclaimed))
+                if kind == 'stop':
+                    return
+
+    def _route_key(self, module, key: str, method: str, args: tuple) -> bool:
+        """Sends a keyed call to the worker that owns the key
+
+        Returns:
+            False if this worker owns it, and the call is to be made here.
+
+        """
+
+        if key is None:
+            return False
+
+        owner = shard_of(key, self.shards)
+        if owner == self.shard_index:
+            return False
+
+        self.queues[owner].put(('call', (module.module_name, method, args)))
+        return True
+
+    def _worker_message(self, kind: str, message) -> bool:
+        """Handles a keyed call or marker from another worker
+
+        Returns:
+            False if the message is not one of those.
+
+        """
+
+        if kind == 'call':
+            (module_name, method, args) = message
+            for module in self.modules:
+                if module.module_name == module_name:
+                    getattr(module, method)(*args)
+            return True
+
+        if kind == 'marker':
+            self.markers += 1
+            return True
+
+        return False
+
+    def _exchange_markers(self, records: multiprocessing.Queue):
+        """Waits until the keyed calls other workers sent have been made
+
+        Each worker puts a marker on every other worker's queue after the
+        calls it sent to it. Once this worker has the markers of all the
+        others, it has made all of their calls. A marker can come before
+        this worker is asked for its store, so they are counted as they
+        come.
+
+        """
+
+        for (owner, other) in enumerate(self.queues):
+            if owner != self.shard_index:
+                other.put(('marker', self.shard_index))
+
+        while self.markers < self.shards - 1:
+            (kind, message) = records.get()
+            self._worker_message(kind, message)
+
+        self.markers = 0
+
+    def _collect(self, kind: str):
+        """Asks every worker for its store, and merges them"""
+
+        self._block_processed()
+
+        for records in self.queues:
+            records.put((kind, None))
+
+        stores = {}
+        unclaimed = {}
+
+        while len(stores) < len(self.workers):
+            try:
+                (index, store, count) = self.replies.get(
+                    timeout=SHARD_REPLY_TIMEOUT)
+            except queue.Empty:
+                lost = [worker.name for worker in self.workers
+                        if not worker.is_alive()]
+                if lost:
+                    log.error(f'Shard worker(s) {", ".join(lost)} exited. '
+                              f'Their store is lost')
+                    break
+                continue
+
+            stores[index] = store
+            unclaimed[index] = count
+
+        self.router.unclaimed = sum(unclaimed.values())
+
+        for module in self.modules:
+            merged = module.merge_stores(
+                [stores[index][module.module_name] for index in sorted(stores)])
+            self.full_store[module.module_name] = merged
+            module.store = merged
+
+    def _flush(self, index: int):
+        self.queues[index].put(('records', self.batches[index]))
+        self.batches[index] = []
+
+    def _block_processed(self):
+        for index in range(self.shards):
+            if self.batches[index]:
+                self._flush(index)
+
+    def _handle_record(self, data: bytes):
+
+        fields = raw_header_fields(data)
+        index = shard_of(fields[0], self.shards) if fields else 0
+
+        batch = self.batches[index]
+        batch.append(data)
+
+        if len(batch) >= SHARD_BATCH_SIZE:
+            self._flush(index)
+
+    def _register_timers(self):
+
+        # The modules run in the workers, which add their own timers. The
+        # journal is not appended to (see __init__)
+
+        self.store_scheduler.every(self.save_store_interval * 60,
+                                   lambda now: self.save_store())
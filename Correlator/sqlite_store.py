@@ -0,0 +1,251 @@
+"""SQLite store backend for module stores
+
+The dict fields of a module store can be kept in an SQLite database rather
+than in memory, so the state of a module can grow beyond the memory
+available, and isn't rewritten whole every time the store is saved. The
+other fields of the store are small, and stay in the pickled store.
+
+Each dict field is a table with the key as its primary key. Fields whose
+values have a timestamp also have an index on it, so the entries older than
+a time can be found with a range scan rather than by reading every entry.
+
+"""
+
+import logging
+import pickle
+import sqlite3
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from datetime import datetime
+from typing import Callable
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_ENTRIES = 10000
+
+
+class SQLiteDict(MutableMapping):
+
+    """ dict that keeps its entries in an SQLite table
+
+    The most recently used entries are cached in memory. Writes are made to
+    the cache, and written to the table in batches by write (write behind).
+    Entries that are read count as changed, like JournalDict, since the value
+    may be modified in place.
+
+    The entries are only made durable by committing the connection, which
+    SQLiteStore does. The connection sees its own uncommitted writes, so
+    queries that need the table to be up to date (len, iteration, older_than)
+    write the cache to it first.
+
+    It pickles as an empty dict: the entries are in the database, not the
+    pickled store.
+
+    Args:
+        connection: Open connection to the database
+        table: Name of the table to keep the entries in
+        timestamp: Function that returns the timestamp of a value, to index
+            the table by, or None
+        cache_entries: Number of entries to keep in memory
+
+    """
+
+    def __init__(self, connection: sqlite3.Connection, table: str,
+                 timestamp: Callable[[object], datetime] = None,
+                 cache_entries: int = DEFAULT_CACHE_ENTRIES):
+
+        self.connection = connection
+        self.table = table
+        self.timestamp = timestamp
+        self.cache_entries = cache_entries
+
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._deleted = set()
+
+        connection.execute(f'CREATE TABLE IF NOT EXISTS "{table}" '
+                           f'(key PRIMARY KEY, timestamp REAL, value BLOB)')
+        if timestamp is not None:
+            connection.execute(f'CREATE INDEX IF NOT EXISTS '
+                               f'"{table}_timestamp" ON "{table}" (timestamp)')
+
+    def __reduce__(self):
+        return dict, ()
+
+    def __repr__(self):
+        return f'<SQLiteDict table {self.table}, {len(self)} entries>'
+
+    def _select(self, key):
+        row = self.connection.execute(
+            f'SELECT value FROM "{self.table}" WHERE key = ?',
+            (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def __getitem__(self, key):
+
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        else:
+            if key in self._deleted:
+                raise KeyError(key)
+            data = self._select(key)
+            if data is None:
+                raise KeyError(key)
+            self._cache[key] = pickle.loads(data)
+
+        self._dirty.add(key)
+        return self._cache[key]
+
+    def __contains__(self, key):
+
+        if key in self._cache:
+            return True
+        if key in self._deleted:
+            return False
+        return self.connection.execute(
+            f'SELECT 1 FROM "{self.table}" WHERE key = ?',
+            (key,)).fetchone() is not None
+
+    def __setitem__(self, key, value):
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        self._dirty.add(key)
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._cache.pop(key, None)
+        self._dirty.discard(key)
+        self._deleted.add(key)
+
+    def __len__(self):
+        self.write()
+        return self.connection.execute(
+            f'SELECT COUNT(*) FROM "{self.table}"').fetchone()[0]
+
+    def __iter__(self):
+        self.write()
+        keys = self.connection.execute(
+            f'SELECT key FROM "{self.table}"').fetchall()
+        return iter([key for (key,) in keys])
+
+    def older_than(self, timestamp: datetime) -> list:
+        """Returns the keys of the entries with a timestamp before timestamp
+
+        Uses the timestamp index, so only those entries are read.
+
+        """
+
+        if self.timestamp is None:
+            raise ValueError(f'Table {self.table} has no timestamp index')
+
+        self.write()
+        keys = self.connection.execute(
+            f'SELECT key FROM "{self.table}" WHERE timestamp < ? '
+            f'ORDER BY timestamp', (timestamp.timestamp(),)).fetchall()
+        return [key for (key,) in keys]
+
+    def write(self):
+        """Writes the changed entries to the table, in one batch
+
+        Then the least recently used entries beyond cache_entries are dropped
+        from the cache.
+
+        """
+
+        if self._dirty:
+            rows = []
+            for key in self._dirty:
+                value = self._cache[key]
+                timestamp = None
+                if self.timestamp is not None:
+                    when = self.timestamp(value)
+                    timestamp = when.timestamp() if when is not None else None
+                rows.append((key, timestamp,
+                             pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+            self.connection.executemany(
+                f'INSERT OR REPLACE INTO "{self.table}" '
+                f'(key, timestamp, value) VALUES (?, ?, ?)', rows)
+            self._dirty = set()
+
+        if self._deleted:
+            self.connection.executemany(
+                f'DELETE FROM "{self.table}" WHERE key = ?',
+                [(key,) for key in self._deleted])
+            self._deleted = set()
+
+        while len(self._cache) > self.cache_entries:
+            self._cache.popitem(last=False)
+
+
+class SQLiteStore:
+
+    """ SQLite database holding the dict fields of a module store
+
+    Args:
+        file_name: Name of the database file
+        cache_entries: Number of entries of each dict field to keep in memory
+
+    """
+
+    def __init__(self, file_name: str,
+                 cache_entries: int = DEFAULT_CACHE_ENTRIES):
+        self.file_name = file_name
+        self.cache_entries = cache_entries
+        self.connection = sqlite3.connect(file_name)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.dicts: list[SQLiteDict] = []
+
+    def attach(self, store,
+               timestamps: dict[str, Callable[[object], datetime]]
+               ) -> tuple[list[str], int]:
+        """Replaces the dict fields of a module store with SQLiteDicts
+
+        Entries already in a field (a store that was kept in memory until
+        now) are moved to the database.
+
+        Args:
+            store: Module store
+            timestamps: Fields to index by timestamp, and the function that
+                returns the timestamp of a value
+
+        Returns:
+            The names of the fields replaced, and the number of entries
+            moved to the database.
+
+        """
+
+        fields = []
+        moved = 0
+
+        for (name, value) in vars(store).items():
+            if not isinstance(value, dict):
+                continue
+
+            values = SQLiteDict(self.connection, name, timestamps.get(name),
+                                self.cache_entries)
+            if value:
+                log.info(f'Moving {len(value)} entries of {name} to '
+                         f'{self.file_name}')
+                values.update(value)
+                moved += len(value)
+
+            setattr(store, name, values)
+            self.dicts.append(values)
+            fields.append(name)
+
+        self.commit()
+        return fields, moved
+
+    def commit(self):
+        """Writes the changes to every dict field, and commits them"""
+
+        for values in self.dicts:
+            values.write()
+        self.connection.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,113 @@
+"""Sectioned persistence store file
+
+The store file holds a section per module, so each module's store can be
+unpickled the first time the module uses it, rather than all of them before
+any record is processed. Sections that were never loaded are copied to the
+next store file as they are, without being unpickled and pickled again.
+
+Layout, with integers in native byte order:
+
+- STORE_MAGIC, then the format version as a 32 bit integer
+- The sections, one after the other. Each is a pickled module store.
+- The index: a pickled dict of the journal sequence number the store
+  includes, and the offset and length of each section by module name
+- The offset of the index, as a 64 bit integer
+
+Store files written before this format are a single pickle of the whole
+store, optionally followed by the sequence number. is_store_file tells
+them apart by the magic bytes.
+
+"""
+
+import mmap
+import pickle
+import struct
+from typing import BinaryIO
+
+STORE_MAGIC = b'CORSTORE'
+STORE_VERSION = 1
+
+_header = struct.Struct('=8sI')
+_trailer = struct.Struct('=Q')
+
+
+class StoreFileError(Exception):
+    pass
+
+
+class StoreFile:
+
+    """ Sections of a store file, loaded on demand
+
+    The file is memory mapped, so sections that are never loaded are never
+    read. The mapping stays valid when the store file is replaced by a newer
+    one, so sections can still be loaded and copied after a save.
+
+    Args:
+        input_file: Store file, open for binary reading
+
+    """
+
+    def __init__(self, input_file: BinaryIO):
+
+        self.mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mapped)
+
+        (magic, version) = _header.unpack_from(view)
+        if magic != STORE_MAGIC:
+            raise StoreFileError('Not a sectioned store file')
+        if version != STORE_VERSION:
+            raise StoreFileError(f'Unsupported store file version {version}')
+
+        (index_offset,) = _trailer.unpack_from(view, len(view) - _trailer.size)
+        index = pickle.loads(view[index_offset:len(view) - _trailer.size])
+
+        self.sequence: int = index['sequence']
+        self.sections: dict[str, memoryview] = {
+            name: view[offset:offset + length]
+            for (name, (offset, length)) in index['sections'].items()}
+
+    def load(self, name: str):
+        """Unpickles a section, and forgets it"""
+
+        return pickle.loads(self.sections.pop(name))
+
+
+def is_store_file(input_file: BinaryIO) -> bool:
+    """Returns True if a file is a sectioned store file. Keeps its position."""
+
+    position = input_file.tell()
+    magic = input_file.read(len(STORE_MAGIC))
+    input_file.seek(position)
+    return magic == STORE_MAGIC
+
+
+def write_store_file(output_file: BinaryIO, full_store: dict,
+                     sections: dict[str, memoryview], sequence: int):
+    """Writes a sectioned store file
+
+    Args:
+        output_file: File open for binary writing
+        full_store: Loaded module stores, by module name, to pickle
+        sections: Sections that were never loaded, by module name, to copy
+        sequence: Sequence number of the last journal entry in the store
+
+    """
+
+    output_file.write(_header.pack(STORE_MAGIC, STORE_VERSION))
+    index = {}
+
+    for (name, store) in full_store.items():
+        offset = output_file.tell()
+        pickle.dump(store, output_file, pickle.HIGHEST_PROTOCOL)
+        index[name] = (offset, output_file.tell() - offset)
+
+    for (name, section) in sections.items():
+        offset = output_file.tell()
+        output_file.write(section)
+        index[name] = (offset, len(section))
+
+    index_offset = output_file.tell()
+    pickle.dump({'sequence': sequence, 'sections': index}, output_file,
+                pickle.HIGHEST_PROTOCOL)
+    output_file.write(_trailer.pack(index_offset))
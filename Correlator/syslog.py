@@ -1,20 +1,35 @@
+import asyncio
 import iso8601
 import logging
+import mmap
+import os
 import pickle
 import re
 import select
+import signal
 import socket
+import time
 from dataclasses import dataclass
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import List, BinaryIO, Callable
 
 from Correlator.config_store import ConfigType, RuntimeConfig
 from Correlator.Event.core import EventProcessor, Event, StatsEvent, SimpleError
-from Correlator.util import ParserError, Module
+from Correlator.journal import StoreJournal
+from Correlator.ring import RecordRing
+from Correlator.sqlite_store import SQLiteStore
+from Correlator.store_file import StoreFile, is_store_file, write_store_file
+from Correlator.util import (ParserError, Module, ModuleRouter, Scheduler,
+                            WallClock)
 
 
 log = logging.getLogger(__name__)
 
+MAX_OCTET_COUNT_DIGITS = 10
+MAX_STREAM_BUFFER = 1048576
+RECORDS_PER_BUFFER = 32
+MAX_REJECTED_APPNAMES = 4096
+
 SyslogConfig = [
     {
         'save_store_interval': {
@@ -23,11 +38,30 @@ SyslogConfig = [
             'type': ConfigType.INTEGER
         }
     },
+    {
+        'store_journal_interval': {
+            'default': 5,
+            'desc': 'Time in seconds in between writes of the changes to the '
+                    'persistence store to its journal. 0 disables the '
+                    'journal, so changes are only saved every '
+                    'save_store_interval minutes.',
+            'type': ConfigType.INTEGER
+        }
+    },
+    {
+        'store_commit_interval': {
+            'default': 5,
+            'desc': 'Time in seconds in between commits of the changes to '
+                    'module stores that use the sqlite store backend.',
+            'type': ConfigType.INTEGER
+        }
+    },
     {
         'buffer_size': {
             'default': 4096,
-            'desc': 'Read buffer size. This must be large enough so that an '
-                    'entire header and structured data can fit.',
+            'desc': 'Minimum read buffer size. This must be large enough so '
+                    'that an entire header and structured data can fit. '
+                    'Receive buffers grow to fit larger records.',
             'type': ConfigType.INTEGER
         }
     },
@@ -54,11 +88,216 @@ SyslogConfig = [
             'desc': 'The TCP port number to listen on.',
             'type': ConfigType.INTEGER
         }
+    },
+    {
+        'listen_mode': {
+            'default': 'single',
+            'desc': 'Network listener to use. single accepts one TCP '
+                    'connection at a time, async serves many simultaneous '
+                    'TCP connections, udp receives UDP datagrams.',
+            'type': ConfigType.STRING
+        }
+    },
+    {
+        'allow_appnames': {
+            'default': '',
+            'desc': 'Comma separated list of appnames to process. Records '
+                    'from other appnames are rejected before they are '
+                    'parsed. Empty means allow all appnames.',
+            'type': ConfigType.STRING
+        }
+    },
+    {
+        'allow_hostnames': {
+            'default': '',
+            'desc': 'Comma separated list of hostnames to process. Records '
+                    'from other hosts are rejected before they are parsed. '
+                    'Empty means allow all hostnames.',
+            'type': ConfigType.STRING
+        }
+    },
+    {
+        'lazy_records': {
+            'default': False,
+            'desc': 'Decode the timestamp, structured data and detail of '
+                    'syslog records only when a module uses them.',
+            'type': ConfigType.BOOLEAN
+        }
+    },
+    {
+        'udp_batch_size': {
+            'default': 64,
+            'desc': 'Maximum number of UDP datagrams to read from the socket '
+                    'each time it becomes readable, before processing them.',
+            'type': ConfigType.INTEGER
+        }
+    },
+    {
+        'udp_max_size': {
+            'default': 8192,
+            'desc': 'Largest UDP datagram accepted, in bytes. Larger '
+                    'datagrams are dropped.',
+            'type': ConfigType.INTEGER
+        }
+    },
+    {
+        'udp_receive_buffer': {
+            'default': 0,
+            'desc': 'Size of the UDP socket receive buffer in bytes. 0 means '
+                    'use the system default.',
+            'type': ConfigType.INTEGER
+        }
+    },
+    {
+        'replay_clock': {
+            'default': True,
+            'desc': 'When replaying a capture file, tell the time by the '
+                    'timestamps of the records, so that timers run and time '
+                    'windows expire as they did when the records were '
+                    'captured.',
+            'type': ConfigType.BOOLEAN
+        }
+    },
+    {
+        'listen_workers': {
+            'default': 1,
+            'desc': 'Number of listener processes. Each binds the listen '
+                    'address and port with SO_REUSEPORT, and has its own '
+                    'modules and persistence store.',
+            'type': ConfigType.INTEGER
+        }
+    },
+    {
+        'ring_buffer_size': {
+            'default': 0,
+            'desc': 'Size in bytes of the shared memory ring buffer between '
+                    'the process that reads from the network and the one '
+                    'that processes records. 0 means read and process in the '
+                    'same process.',
+            'type': ConfigType.INTEGER
+        }
+    },
+    {
+        'shards': {
+            'default': 1,
+            'desc': 'Number of worker processes to process records in. '
+                    'Records are sent to a worker by their hostname.',
+            'type': ConfigType.INTEGER
+        }
     }
 
 ]
 
 
+class TimestampParser:
+
+    """ Parses RFC 5424 timestamps, with a cache
+
+    Timestamps are returned as naive datetimes holding the time as written,
+    the same as iso8601.parse_date(timestamp).replace(tzinfo=None).
+
+    Records received within the same second share the same date, time and
+    offset, so the date and time up to the second are parsed once and cached.
+    Only the fractional seconds are parsed for each record. Anything that is
+    not in the RFC 5424 profile (YYYY-MM-DDTHH:MM:SS[.1*6DIGIT] followed by Z
+    or +/-HH:MM) is handed to iso8601.
+
+    Args:
+        max_cache: Number of cached seconds before the cache is cleared
+
+    """
+
+    def __init__(self, max_cache: int = 4096):
+        self.max_cache = max_cache
+        self._seconds = {}
+        self._offsets = set()
+
+    def parse(self, timestamp_str: str) -> datetime:
+        """Returns the timestamp as a naive datetime
+
+        Raises:
+            iso8601.ParseError: If the timestamp is invalid
+
+        """
+
+        prefix = timestamp_str[0:19]
+        base = self._seconds.get(prefix)
+
+        if base is None:
+            base = self._parse_prefix(prefix)
+            if base is None:
+                return self._parse_slow(timestamp_str)
+
+        # The offset is either Z or +/-HH:MM, with optional fractional
+        # seconds in between. Anything else, including no offset at all, is
+        # left to iso8601.
+
+        length = len(timestamp_str)
+        if length <= 19:
+            return self._parse_slow(timestamp_str)
+        if timestamp_str[-1] == 'Z':
+            end = length - 1
+        elif (length >= 25 and timestamp_str[-6] in '+-'
+                and timestamp_str[-3] == ':'):
+            end = length - 6
+        else:
+            return self._parse_slow(timestamp_str)
+        offset = timestamp_str[end:]
+
+        if end == 19:
+            fraction = None
+        else:
+            fraction = timestamp_str[20:end]
+            if (timestamp_str[19] != '.' or not 0 < len(fraction) <= 6
+                    or not fraction.isdigit()):
+                return self._parse_slow(timestamp_str)
+
+        if offset not in self._offsets:
+
+            if not self._valid_offset(offset):
+                return self._parse_slow(timestamp_str)
+            self._offsets.add(offset)
+
+        if fraction is None:
+            return base
+        return base.replace(microsecond=int(fraction.ljust(6, '0')))
+
+    def _parse_prefix(self, prefix: str):
+
+        if (len(prefix) != 19 or prefix[4] != '-' or prefix[7] != '-'
+                or prefix[10] != 'T' or prefix[13] != ':'
+                or prefix[16] != ':'):
+            return None
+
+        try:
+            base = datetime.fromisoformat(prefix)
+        except ValueError:
+            return None
+
+        if len(self._seconds) >= self.max_cache:
+            self._seconds.clear()
+        self._seconds[prefix] = base
+
+        return base
+
+    @staticmethod
+    def _valid_offset(offset: str):
+
+        if offset == 'Z':
+            return True
+
+        return (len(offset) == 6 and offset[0] in '+-' and offset[3] == ':'
+                and offset[1:3].isdigit() and offset[4:6].isdigit()
+                and int(offset[1:3]) <= 23 and int(offset[4:6]) <= 59)
+
+    @staticmethod
+    def _parse_slow(timestamp_str: str):
+        return iso8601.parse_date(timestamp_str).replace(tzinfo=None)
+
+
+timestamp_parser = TimestampParser()
+
+
 class SyslogRecord:
 
     main_regex = (
@@ -122,13 +361,11 @@ class SyslogRecord:
 
         self.timestamp_str = self.m.group('timestamp_str')
         try:
-            timestamp_tz = iso8601.parse_date(self.timestamp_str)
+            self.timestamp = timestamp_parser.parse(self.timestamp_str)
         except iso8601.ParseError:
             self.error = 'Cannot parse timestamp'
             return
 
-        self.timestamp = timestamp_tz.replace(tzinfo=None)
-
         self.priority = self.m.group('priority')
         self.hostname = self.m.group('hostname')
         self.appname = self.m.group('appname')
@@ -142,60 +379,126 @@ class SyslogRecord:
             self.error = f'Cannot parse structured data: {e}'
             return
 
+    def decode(self) -> bool:
+        """Returns False if the record has an error
+
+        The record is decoded when it is created, so there is nothing left
+        to decode. See LazySyslogRecord.decode.
+
+        """
+
+        return not self.error
+
     @staticmethod
     def _parse_sdata(dataline):
+        """Splits the structured data from the message in the rest of a record
 
-        has_structured_data = False
-        element_id = None
-        state = 1
+        This is a single pass over the line, tracking a position rather than
+        slicing off what has been parsed. Param values may contain the
+        escaped characters \\", \\\\ and \\] as described in RFC 5424
+        section 6.3.3.
+
+        Returns:
+            tuple of the message, and a dict of SD-ID to a dict of params.
+
+        """
+
+        length = len(dataline)
+        if not length:
+            raise ParserError('Ran out of content')
+
+        # NILVALUE, no structured data
+
+        if dataline[0] == '-':
+            if length == 1:
+                return '', {}
+            if not dataline[1].isspace():
+                raise ParserError(f'SD-DATA {dataline} parse failed')
+            return dataline[1:].lstrip(), {}
+
+        if dataline[0] != '[':
+            raise ParserError(f'SD-DATA {dataline} parse failed')
+
+        find = dataline.find
+        has_escapes = find('\\') != -1
         parsed_struc = {}
+        pos = 0
 
-        def add_param(eid, param_key, param_value):
-            if element_id not in parsed_struc:
-                parsed_struc[eid] = {}
+        while pos < length and dataline[pos] == '[':
 
-            parsed_struc[eid][param_key] = param_value
+            # SD-ID, terminated by a space or the end of the element
 
-        while True:
-            if not dataline:
-                raise ParserError('Ran out of content')
-            if state == 1:
-
-                # if not has_structured_data and dataline[0:2] == '- ':
-                #     return dataline[2:], {}
-
-                if not has_structured_data:
-                    m = re.match(r'-\s+(.+)', dataline)
-                    if m:
-                        return m.group(1), {}
-
-                m = re.match(r'\[(\w+) (.*)', dataline)
-                if not m:
-                    if not has_structured_data:
-                        raise ParserError(
-                            f'SD-DATA {dataline} parse failed ')
-                    else:
-                        return dataline.lstrip(), parsed_struc
-                element_id = m.group(1)
-                dataline = m.group(2)
-                state = 2
+            space = find(' ', pos + 1)
+            bracket = find(']', pos + 1)
+            if bracket == -1:
+                raise ParserError(f'SD-DATA {dataline} is not terminated')
+
+            if space == -1 or bracket < space:
+                parsed_struc.setdefault(dataline[pos + 1:bracket], {})
+                pos = bracket + 1
                 continue
-            elif state == 2:
-                m = re.match(r'](.*)', dataline)
-                if m:
-                    dataline = m.group(1)
-                    state = 1
-                    continue
-                m = re.match(r'(.+?)="([^"]*)"\s*(.*)', dataline)
 
-                if m:
-                    add_param(element_id, m.group(1), m.group(2))
-                    has_structured_data = True
-                    dataline = m.group(3)
-                    continue
-                else:
+            params = parsed_struc.setdefault(dataline[pos + 1:space], {})
+            pos = space
+
+            # SD-PARAMs, until the end of the element
+
+            while True:
+                while pos < length and dataline[pos] == ' ':
+                    pos += 1
+                if pos >= length:
+                    raise ParserError('Ran out of content')
+                if dataline[pos] == ']':
+                    pos += 1
+                    break
+
+                equals = find('="', pos)
+                if equals == -1 or find(' ', pos, equals) != -1:
                     raise ParserError(
-                        f'SD-DATA Key/Value {dataline} parse failed')
+                        f'SD-DATA Key/Value {dataline[pos:]} parse failed')
+
+                value_start = equals + 2
+                quote = find('"', value_start)
+                if quote == -1:
+                    raise ParserError(
+                        f'SD-DATA Key/Value {dataline[pos:]} parse failed')
+
+                if has_escapes:
+                    backslash = find('\\', value_start, quote)
+                else:
+                    backslash = -1
+
+                if backslash == -1:
+                    value = dataline[value_start:quote]
+                else:
+                    pieces = []
+                    index = value_start
+                    while backslash != -1:
+                        pieces.append(dataline[index:backslash])
+                        escaped = dataline[backslash + 1:backslash + 2]
+                        if escaped not in ('"', '\\', ']'):
+                            # Not an escape sequence, the backslash is kept
+                            pieces.append('\\')
+                            escaped = ''
+                            index = backslash + 1
+                        else:
+                            index = backslash + 2
+                        pieces.append(escaped)
+                        if index > quote:
+                            # The quote was escaped, find the real one
+                            quote = find('"', index)
+                            if quote == -1:
+                                raise ParserError(
+                                    f'SD-DATA Key/Value {dataline[pos:]} '
+                                    f'parse failed')
+                        backslash = find('\\', index, quote)
+                    pieces.append(dataline[index:quote])
+                    value = ''.join(pieces)
+
+                params[dataline[pos:equals]] = value
+                pos = quote + 1
+
+        return dataline[pos:].lstrip(), parsed_struc
 
     def __repr__(self):
         # todo: why?
@@ -209,222 +512,973 @@ class SyslogRecord:
         return self.record_length
 
 
-@dataclass
-class RawSyslogRecord:
-    timestamp: str
-    priority: str
-    hostname: str
-    appname: str
-    proc_id: str
-    msg_id: str
-    structured_data: dict
+# Marks a LazySyslogRecord field that has not been decoded yet
 
+_UNDECODED = object()
 
-# module_name = 'syslog_server'
 
+class LazySyslogRecord:
 
-class SyslogServer:
+    """ Syslog record that decodes its fields on demand
 
-    """ Read and process syslog records from the network, or file.
+    A drop-in alternative to SyslogRecord, for use as the record class of
+    SyslogServer. Only the header fields are split out when the record is
+    created. The timestamp, structured data and detail are decoded the first
+    time they are used, so records that no module is interested in are cheap.
 
-    Can also write records to a capture file for later replay.
+    Until decode is called, error only reflects problems found in the header.
+    A bad timestamp or structured data sets the error when the field is
+    first used, and the field's value is None. SyslogServer decodes every
+    record it passes to a module, so modules never see those.
 
     Args:
-        modules: List of Correlator modules in this stack
-        processor: Instance of EventProcessor with registered event handlers
-        discovery_method: Callable that can help determine the syslog trailer
-        record_filter:  Record filter list
-        store_file: Name of file to read and write the persistence store
-        record: Custom record class to use (i.e. subclass of SyslogRecord)
+        record: Raw syslog record
 
     """
 
-    ConfigModuleName = 'syslog_server'      # For Runtime configuration
-    RuntimeConfig.add(SyslogConfig, ConfigModuleName)
+    __slots__ = ('original_record', 'record_length', 'error', 'priority',
+                 'version', 'timestamp_str', 'hostname', 'appname', 'proc_id',
+                 'msg_id', '_rest', '_timestamp', '_detail',
+                 '_structured_data')
 
-    def __init__(self, modules: List[Module], processor: EventProcessor,
-                 discovery_method: Callable[[RawSyslogRecord], bytes] = None,
-                 record_filter=None, store_file: str = None,
-                 record: type = SyslogRecord):
+    def __init__(self, record: bytes):
 
-        self.modules = modules
-        self.processor = processor
-        self.syslog_trailer = None
-        self.trailer_discovery_method = discovery_method
-        self.record_num = 0
-        self.record_filter = record_filter
-        self.output_file = None
-        self.store_file: str = store_file
-        self.skip_save_store = False
-        self.full_store = {}
-        self.store_timestamp = None
-        self.last_tick = None
-        self.record = record
+        self.original_record = record
+        self.record_length = len(record)
+        self.error = None
+        self._timestamp = _UNDECODED
+        self._detail = _UNDECODED
+        self._structured_data = _UNDECODED
 
-        if store_file is not None:
-            self.load_store()
+        # <PRI>VERSION TIMESTAMP HOSTNAME APP-NAME PROCID MSGID REST
 
-        for module in modules:
-            module.event_processor = processor
-            if module.module_name not in self.full_store:
-                self.full_store[module.module_name] = module.model()
-            module.store = self.full_store[module.module_name]
-            module.post_init_store()
+        fields = record.split(b' ', 6)
+        pri_version = fields[0]
+        close = pri_version.find(b'>')
 
-        self.save_store_interval = RuntimeConfig.get(
-            f'{self.ConfigModuleName}.save_store_interval')
-        self.buffer_size = RuntimeConfig.get(f'{self.ConfigModuleName}.buffer_size')
+        if (len(fields) != 7 or not all(fields)
+                or pri_version[0:1] != b'<' or close < 2
+                or not pri_version[1:close].isdigit()
+                or not pri_version[close + 1:].isdigit()):
+            self._fail('1st stage parse failure')
+            return
 
-        self.default_syslog_trailer = RuntimeConfig.get(
-            f'{self.ConfigModuleName}.default_trailer').encode('utf-8')
+        try:
+            self.priority = pri_version[1:close].decode('utf-8')
+            self.version = pri_version[close + 1:].decode('utf-8')
+            self.timestamp_str = fields[1].decode('utf-8')
+            self.hostname = fields[2].decode('utf-8')
+            self.appname = fields[3].decode('utf-8')
+            self.proc_id = fields[4].decode('utf-8')
+            self.msg_id = fields[5].decode('utf-8')
+        except UnicodeDecodeError:
+            self._fail('1st stage parse failure')
+            return
 
-    def debug_dump_store(self):
-        log.debug(repr(self.full_store))
+        self._rest = fields[6]
 
-    def save_store(self):
+    def _fail(self, message):
+        self.error = message
+        self.priority = None
+        self.version = None
+        self.timestamp_str = None
+        self.hostname = None
+        self.appname = None
+        self.proc_id = None
+        self.msg_id = None
+        self._rest = None
 
-        if self.skip_save_store:
-            return
+    def decode(self) -> bool:
+        """Decodes the timestamp, structured data and detail now
 
-        if not self.store_file:
-            log.info('Save store: Persistence not enabled')
-            self.skip_save_store = True
-            return
+        Returns:
+            False if the record has an error, including one found in them.
 
-        with open(self.store_file, 'wb') as output_file:
-            pickle.dump(self.full_store, output_file, pickle.HIGHEST_PROTOCOL)
-            log.info(f'Save store: store written to {self.store_file} and is {output_file.tell()} bytes')
+        """
 
-    def load_store(self):
-        if not self.store_file:
-            log.info("Load store: Persistence not enabled.")
-            return
+        return (not self.error and self.timestamp is not None
+                and self.detail is not None)
 
-        try:
-            with open(self.store_file, 'rb') as input_file:
-                self.full_store = pickle.load(input_file)
-                log.info(f'Load store: Store loaded from file '
-                         f'{self.store_file}.')
-        except FileNotFoundError:
-            log.info(
-                f'Load store: Store file {self.store_file} does not exist. '
-                f'Initializing new store')
+    @property
+    def timestamp(self) -> datetime | None:
+        if self._timestamp is _UNDECODED:
+            try:
+                self._timestamp = timestamp_parser.parse(self.timestamp_str)
+            except iso8601.ParseError:
+                self._timestamp = None
+                self.error = 'Cannot parse timestamp'
+        return self._timestamp
+
+    @property
+    def detail(self) -> str | None:
+        if self._detail is _UNDECODED:
+            self._decode_rest()
+        return self._detail
+
+    @property
+    def structured_data(self) -> dict | None:
+        if self._structured_data is _UNDECODED:
+            self._decode_rest()
+        return self._structured_data
+
+    def _decode_rest(self):
+
+        rest = self._rest
+        pos = rest.find(b'\xef\xbb\xbf')
+        if pos >= 0:
+            rest = rest[0:pos] + rest[pos + 3:]
 
-    def from_file(self, input_file: BinaryIO, output_file: BinaryIO = None):
-        """ Processes saved syslog data from a capture file rather than network
+        # Like SyslogRecord, only the first line is used
 
-        Also supports writing to a capture file. Combined with the record_filter
-        argument in the constructor, this provides rudimentary functionality to
-        edit capture files by reading from one and writing to another, while
-        stripping som packets.
+        try:
+            decoded = rest.decode('utf-8')
+        except UnicodeDecodeError:
+            self._detail = None
+            self._structured_data = None
+            self.error = 'Cannot decode record'
+            return
 
-        Args:
-            input_file: File object of readable binary file
-            output_file: File object of writable binary file
+        pos = decoded.find('\n')
+        if pos >= 0:
+            decoded = decoded[0:pos]
 
-        """
+        try:
+            self._detail, self._structured_data = (
+                SyslogRecord._parse_sdata(decoded))
+        except ParserError as e:
+            self._detail = None
+            self._structured_data = None
+            self.error = f'Cannot parse structured data: {e}'
 
-        last = b''
-        self.output_file = output_file
+    def __repr__(self):
+        fields = {
+            'priority': self.priority,
+            'version': self.version,
+            'timestamp_str': self.timestamp_str,
+            'hostname': self.hostname,
+            'appname': self.appname,
+            'proc_id': self.proc_id,
+            'msg_id': self.msg_id,
+        }
+        return f'{fields} ({self.structured_data})'
 
-        while True:
-            block = input_file.read(self.buffer_size)
+    def __str__(self):
+        return (f'{self.timestamp.strftime("%Y-%m-%d %H:%M:%S")}: '
+                f'{self.hostname} {self.appname} {self.proc_id} {self.detail}')
 
-            # Determine the trailer (syslog record seperator) if
-            # we haven't already.
+    def __len__(self):
+        return self.record_length
 
-            if self.syslog_trailer is None:
-                self.syslog_trailer = self.discover_trailer(block)
-                if self.syslog_trailer is None:
-                    self.processor.dispatch_event(
-                        SimpleError(
-                            {'message': 'Problem running trailer discovery'}))
-                    return
 
-            data = last + block
-            if not data:
-                return
-            last = self._process_block(data)
+def raw_header_fields(record: bytes) -> tuple[bytes, bytes] | None:
+    """Locates the hostname and appname in a raw syslog record
 
-    def handle_connection(self, host, port, output_file: BinaryIO = None):
+    They are the 3rd and 4th space delimited fields of the header:
+    <PRI>VERSION TIMESTAMP HOSTNAME APP-NAME ...
 
-        server_socket = socket.socket()
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((host, port))
+    Returns:
+        tuple of hostname and appname, or None if the header is too short
 
-        server_socket.listen(1)
-        server_socket.setblocking(False)
+    """
 
-        log.info(f'Server listening on {host}:{port}')
+    pos = record.find(b' ')
+    if pos == -1:
+        return None
+    pos = record.find(b' ', pos + 1)
+    if pos == -1:
+        return None
+    appname_start = record.find(b' ', pos + 1) + 1
+    if not appname_start:
+        return None
+    appname_end = record.find(b' ', appname_start)
+    if appname_end == -1:
+        return None
 
-        self.last_tick = datetime.now()
+    return record[pos + 1:appname_start - 1], record[appname_start:appname_end]
 
-        while True:
-            timeout = self._seconds_remaining()
-            readable, writable, errored = select.select(
-                [server_socket], [], [], timeout)
 
-            now = datetime.now()
+def _allow_set(value: str) -> set[bytes] | None:
+    names = {name.strip().lower().encode('utf-8')
+             for name in value.split(',') if name.strip()}
+    return names or None
 
-            if not readable:
-                # Always tick if we time out, chances are we are at a boundary
-                self._tick(now)
-                continue
 
-            if self.last_tick.minute != now.minute:
-                self._tick(now)
+@dataclass
+class RawSyslogRecord:
+    timestamp: str
+    priority: str
+    hostname: str
+    appname: str
+    proc_id: str
+    msg_id: str
+    structured_data: dict
 
-            conn, (remote_host, remote_port) = server_socket.accept()
-            log.info(f'Connection from: {remote_host}:{remote_port}')
-            break
 
-        last = b''
+class SyslogStream:
 
-        self.output_file = output_file
+    """ Framing state for a single stream of syslog data
 
-        while True:
-            timeout = self._seconds_remaining()
-            # Nonblocking reads, for the same reason.
-            readable, writable, errored = select.select(
-                [conn], [], [], timeout)
+    Every network connection (and capture file) has its own receive buffer
+    and its own framing. The framing is detected from the first block
+    received on the stream:
 
-            now = datetime.now()
-            if self.last_tick.minute != now.minute:
-                self._tick(now)
+    - RFC 6587 octet counting if the block starts with a digit. Each record
+      is prefixed with its length, so records are sliced directly.
+    - Otherwise, RFC 6587 non-transparent framing. Records are separated by
+      the syslog trailer, which is determined by trailer discovery.
 
-            if not readable:
-                continue
+    Data is received directly into a reusable buffer (see get_buffer and
+    buffer_updated). Records are located by moving a start offset through
+    the buffer, and each one is copied out exactly once when it is handed to
+    the server for processing. The buffer is compacted only when it runs low
+    on free space, and is resized to fit several records of the average size
+    seen so far.
 
-            # Otherwise, read
+    Args:
+        server: SyslogServer that processes the records from this stream
+        name: Description of the stream, for logging
 
-            block = conn.recv(self.buffer_size)
+    """
 
-            if not block:
-                log.debug("read block evaluated false")
+    def __init__(self, server: 'SyslogServer', name: str = None):
+        self.server = server
+        self.name = name
+        self.octet_counting = None
+        self.syslog_trailer = None
+        self.error = None
+
+        self.min_size = server.buffer_size
+        self.buffer = bytearray(self.min_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+        self.records = 0
+        self.record_bytes = 0
+
+    def get_buffer(self) -> memoryview:
+        """Returns the free space at the end of the buffer to receive into"""
+
+        if len(self.buffer) - self.end < self.min_size // 4:
+            self._compact()
+
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes: int) -> bool:
+        """Processes nbytes of data received into the buffer from get_buffer
+
+        Processes every complete record in the buffer, keeping any partial
+        record for the next block.
+
+        Returns:
+            False if the stream cannot be framed. The reason is in error.
+
+        """
+
+        self.end += nbytes
+
+        # Determine the framing if we haven't already, from at most one
+        # buffer_size block
+
+        if self.octet_counting is None:
+            block_end = min(self.end, self.start + self.min_size)
+            if not self._detect_framing(
+                    bytes(self.view[self.start:block_end])):
+                return False
+
+        if self.octet_counting:
+            self._process_octet_block()
+        else:
+            self._process_block()
+
+        if self.start == self.end:
+            # Everything was processed, start again at the beginning
+            self.start = 0
+            self.end = 0
+
+        self.server._block_processed()
+
+        return self.error is None
+
+    def process_buffer(self, buffer) -> bool:
+        """Processes all records in a complete buffer, in place
+
+        The buffer (for example a memory mapped file) is used instead of the
+        stream's own buffer, so none of it is copied other than the records
+        themselves.
+
+        Returns:
+            False if the stream cannot be framed. The reason is in error.
+
+        """
+
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start = 0
+        self.end = 0
+
+        try:
+            return self.buffer_updated(len(buffer))
+        finally:
+            self.view.release()
+
+    def feed(self, block: bytes) -> bool:
+        """Adds a block of data, received elsewhere, to the stream
+
+        Returns:
+            False if the stream cannot be framed. The reason is in error.
+
+        """
+
+        pos = 0
+        while pos < len(block):
+            buffer = self.get_buffer()
+            nbytes = min(len(buffer), len(block) - pos)
+            buffer[0:nbytes] = block[pos:pos + nbytes]
+            pos += nbytes
+            if not self.buffer_updated(nbytes):
+                return False
+
+        return True
+
+    def frame(self, record: bytes) -> bytes:
+        """Returns a record framed the same way as this stream"""
+
+        if self.octet_counting:
+            return str(len(record)).encode('utf-8') + b' ' + record
+        return record + self.syslog_trailer
+
+    def _detect_framing(self, block):
+
+        if block[0:1].isdigit():
+            log.debug(f'{self.name}: Using octet-counted framing')
+            self.octet_counting = True
+            return True
+
+        self.syslog_trailer = self.server.discover_trailer(block)
+        if self.syslog_trailer is None:
+            self.error = 'Cannot locate structured data in raw block'
+            return False
+
+        self.octet_counting = False
+        return True
+
+    def _compact(self):
+        """Moves the partial record to the start of the buffer
+
+        Resizes the buffer at the same time, if the partial record or the
+        average record size calls for it.
+
+        """
+
+        pending = self.end - self.start
+        size = len(self.buffer)
+
+        wanted = max(self.min_size, pending * 2)
+        if self.records:
+            wanted = max(wanted, min(
+                MAX_STREAM_BUFFER,
+                self.record_bytes // self.records * RECORDS_PER_BUFFER))
+
+        if wanted > size or wanted * 4 <= size:
+            log.debug(f'{self.name}: Resizing receive buffer from {size} to '
+                      f'{wanted} bytes')
+            buffer = bytearray(wanted)
+            buffer[0:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start:
+            self.buffer[0:pending] = self.buffer[self.start:self.end]
+
+        self.start = 0
+        self.end = pending
+
+    def _record(self, start, end):
+
+        self.records += 1
+        self.record_bytes += end - start
+        self.server._process_record(bytes(self.view[start:end]), self)
+
+    def _process_block(self):
+
+        find = self.buffer.find
+        trailer = self.syslog_trailer
+        trailer_length = len(trailer)
+        start = self.start
+        end = self.end
+
+        while True:
+            pos = find(trailer, start, end)
+            if pos == -1:
+                break
+            self._record(start, pos)
+            start = pos + trailer_length
+
+        self.start = start
+
+    def _process_octet_block(self):
+
+        find = self.buffer.find
+        start = self.start
+        end = self.end
+
+        while start < end:
+            pos = find(b' ', start,
+                       min(end, start + MAX_OCTET_COUNT_DIGITS + 1))
+            if pos == -1:
+                if end - start > MAX_OCTET_COUNT_DIGITS:
+                    self.error = 'Octet count is missing or too long'
+                    start = end
+                break
+
+            octet_count = self.buffer[start:pos]
+            if not octet_count.isdigit():
+                self.error = f'Invalid octet count {bytes(octet_count)!r}'
+                start = end
+                break
+
+            record_end = pos + 1 + int(octet_count)
+            if record_end > end:
                 break
 
-            # Determine the syslog trailer (record separator) if we haven't
-            # already
+            self._record(pos + 1, record_end)
+            start = record_end
+
+        self.start = start
+
+
+# module_name = 'syslog_server'
+
+
+def fork_listeners(count: int) -> int | None:
+    """Forks count listener processes, and waits for them to exit
+
+    Each child process returns immediately with its index, and should run its
+    own SyslogServer. The children are put in their own process group, so an
+    interrupt is only delivered to them once, when the parent is interrupted.
+    When the parent is terminated, the children are interrupted too, so they
+    don't keep listening on the port once it has gone.
+
+    Returns:
+        The index of the listener in a child, or None in the parent once all
+        the children have exited.
+
+    """
+
+    children = {}
+
+    def interrupt_children(signum=None, frame=None):
+        for pid in children:
+            os.kill(pid, signal.SIGINT)
+
+    previous = signal.signal(signal.SIGTERM, interrupt_children)
+
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, previous)
+            os.setpgrp()
+            return index
+        children[pid] = index
+
+    log.info(f'Started {count} listener processes')
+
+    try:
+        while children:
+            try:
+                (pid, status) = os.wait()
+            except KeyboardInterrupt:
+                interrupt_children()
+                continue
+
+            index = children.pop(pid)
+            log.info(f'Listener process {index} exited with status '
+                     f'{os.waitstatus_to_exitcode(status)}')
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+    return None
+
+
+class SyslogServer:
+
+    """ Read and process syslog records from the network, or file.
+
+    Can also write records to a capture file for later replay.
+
+    Args:
+        modules: List of Correlator modules in this stack
+        processor: Instance of EventProcessor with registered event handlers
+        discovery_method: Callable that can help determine the syslog trailer
+        record_filter:  Record filter list
+        store_file: Name of file to read and write the persistence store
+        record: Custom record class to use (i.e. subclass of SyslogRecord)
+        clock: Clock for the server and modules. A ReplayClock follows the
+            timestamps of the records, for replaying capture files.
+
+    """
+
+    ConfigModuleName = 'syslog_server'      # For Runtime configuration
+    RuntimeConfig.add(SyslogConfig, ConfigModuleName)
+
+    def __init__(self, modules: List[Module], processor: EventProcessor,
+                 discovery_method: Callable[[RawSyslogRecord], bytes] = None,
+                 record_filter=None, store_file: str = None,
+                 record: type = SyslogRecord, clock: WallClock = None):
 
-            if self.syslog_trailer is None:
-                self.syslog_trailer = self.discover_trailer(block)
-                if self.syslog_trailer is None:
-                    self.processor.dispatch_event(
-                        SimpleError({
-                            'message': 'Cannot locate structured data in raw block'
-                        }))
+        self.modules = modules
+        self.router = ModuleRouter(modules)
+        self.processor = processor
+        self.trailer_discovery_method = discovery_method
+        self.record_num = 0
+        self.dropped = 0
+        self.record_filter = record_filter
+        self.output_file = None
+        self.store_file: str = store_file
+        self.skip_save_store = False
+        self.full_store = {}
+        self.store_timestamp = None
+        self.record = record
+        self.clock = clock or WallClock()
+        self.store_sequence = 0
+        self.store_sections: StoreFile | None = None
+        self.deferred_changes: dict[str, list] = {}
+
+        self.journal_interval = RuntimeConfig.get(
+            f'{self.ConfigModuleName}.store_journal_interval')
+        self.journal = None
+        self._save_process = None
+        if store_file is not None and self.journal_interval:
+            self.journal = StoreJournal(f'{store_file}.journal')
+
+        if store_file is not None:
+            self.load_store()
+
+        for module in modules:
+            if (module.module_name not in self.full_store
+                    and module.module_name not in self._unloaded_sections()):
+                self.full_store[module.module_name] = module.model()
+
+        if self.journal is not None:
+            applied = self.journal.replay(self.full_store, self.store_sequence,
+                                          self.deferred_changes)
+            if applied:
+                log.info(f'Load store: {applied} change(s) applied from '
+                         f'journal {self.journal.file_name}')
+
+        self.store_commit_interval = RuntimeConfig.get(
+            f'{self.ConfigModuleName}.store_commit_interval')
+        self.databases: list[SQLiteStore] = []
+        self._open_databases()
+
+        # Stores still in the sections of the store file are loaded when the
+        # module first uses them
+
+        for module in modules:
+            module.event_processor = processor
+            module.clock = self.clock
+            if module.module_name in self.full_store:
+                self._bind_store(module, self.full_store[module.module_name])
+            else:
+                module.defer_store(
+                    lambda module=module: self._bind_store(
+                        module, self._load_section(module.module_name)))
+
+        self.save_store_interval = RuntimeConfig.get(
+            f'{self.ConfigModuleName}.save_store_interval')
+        self.scheduler = Scheduler(self.clock)
+        # Persistence follows the real time, even when replaying
+        self.store_scheduler = Scheduler(WallClock())
+        self._register_timers()
+        self.reuse_port = RuntimeConfig.get(
+            f'{self.ConfigModuleName}.listen_workers') > 1
+        self.buffer_size = RuntimeConfig.get(f'{self.ConfigModuleName}.buffer_size')
+
+        self.default_syslog_trailer = RuntimeConfig.get(
+            f'{self.ConfigModuleName}.default_trailer').encode('utf-8')
+
+        # Pre-parse filter
+
+        self.allow_appnames = _allow_set(RuntimeConfig.get(
+            f'{self.ConfigModuleName}.allow_appnames'))
+        self.allow_hostnames = _allow_set(RuntimeConfig.get(
+            f'{self.ConfigModuleName}.allow_hostnames'))
+        self.rejected: dict[str, int] = {}
+        self.rejected_other = 0
+
+        self.ring: RecordRing | None = None
+
+    def debug_dump_store(self):
+        log.debug(repr(self.full_store))
+
+    def _unloaded_sections(self) -> dict:
+        """Sections of the store file that have not been loaded, by name"""
+
+        if self.store_sections is None:
+            return {}
+        return self.store_sections.sections
+
+    def _load_section(self, name: str):
+        """Loads a module store from its section of the store file
+
+        The journal changes replayed for it are applied, and it is added to
+        the full store.
+
+        """
+
+        store = self.store_sections.load(name)
+        for module_changes in self.deferred_changes.pop(name, []):
+            StoreJournal.apply_module(store, module_changes)
+
+        self.full_store[name] = store
+        log.debug(f'Load store: Loaded the store of {name}')
+        return store
+
+    def _bind_store(self, module: Module, store):
+        module.store = store
+        if self.journal is not None:
+            self.journal.track(store)
+        module.post_init_store()
+
+    def _load_deferred(self):
+        """Loads the sections that journal changes were replayed for
+
+        Their changes are only in the journal until they are saved with the
+        store.
+
+        """
+
+        for module in self.modules:
+            if module.module_name in self.deferred_changes:
+                self._bind_store(module, self._load_section(module.module_name))
+
+        for name in list(self.deferred_changes):
+            self._load_section(name)
+
+    def _open_databases(self):
+        """Moves module store dict fields to SQLite, for the sqlite backend
+
+        Each module that uses it has its own database, named after the store
+        file and the module. Once a store that was in memory has been moved
+        to its database, the store is saved, so the journal entries that
+        were moved are not replayed on top of the database next time.
+
+        """
+
+        moved = 0
+
+        for module in self.modules:
+            backend = module.get_config('store_backend')
+            if backend == 'pickle':
+                continue
+            if backend != 'sqlite':
+                raise ValueError(f'Unknown store backend for module '
+                                 f'{module.module_name}: {backend}')
+
+            if not self.store_file:
+                log.warning(f'Module {module.module_name}: The sqlite store '
+                            f'backend needs a store file. Keeping the store '
+                            f'in memory.')
+                continue
+
+            if module.module_name not in self.full_store:
+                self._load_section(module.module_name)
+
+            database = SQLiteStore(
+                f'{self.store_file}.{module.module_name}.sqlite',
+                module.get_config('store_cache_entries'))
+            (fields, entries) = database.attach(
+                self.full_store[module.module_name], module.store_timestamps)
+            log.info(f'Load store: {module.module_name} keeps '
+                     f'{", ".join(fields)} in {database.file_name}')
+            self.databases.append(database)
+            moved += entries
+
+        if moved:
+            self.save_store(background=False)
+
+    def commit_databases(self):
+        """Commits the changes to the module stores kept in SQLite"""
+
+        for database in self.databases:
+            database.commit()
+
+    def save_store(self, background: bool = True):
+        """Writes the whole persistence store to the store file
+
+        In the background, a child process is forked to write the copy on
+        write snapshot of the store while this one carries on. The save is
+        skipped if the previous one is still being written. Otherwise (at
+        shutdown) it waits for any save in progress, then writes the store
+        itself.
+
+        The store is written to a temporary file, which then replaces the
+        store file, so the store file is always complete.
+
+        """
+
+        if self.skip_save_store:
+            return
+
+        if not self.store_file:
+            log.info('Save store: Persistence not enabled')
+            self.skip_save_store = True
+            return
+
+        if not self._reap_save(wait=not background):
+            log.warning('Save store: The previous save is still running. '
+                        'Skipping this one.')
+            return
+
+        self.commit_databases()
+        self._load_deferred()
+
+        # The changes tracked until now are journaled before the journal is
+        # rotated, so they are kept in the older segments if the save fails.
+        # The snapshot is followed by the sequence number of the last journal
+        # entry it includes
+
+        sequence = 0
+        segment = None
+        if self.journal is not None:
+            self._append_journal()
+            sequence = self.journal.sequence
+            segment = self.journal.rotate(self.full_store)
+
+        if not background:
+            self._write_store(sequence)
+            if segment is not None:
+                self.journal.remove_segments(segment)
+            return
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self._write_store(sequence)
+                os._exit(0)
+            except BaseException as e:
+                log.error('Save store: Failed to write the store')
+                log.exception(e)
+                os._exit(1)
+
+        self._save_process = (pid, segment)
+
+    def _append_journal(self):
+        """Writes the changes made to the store since the last journal entry"""
+        self.journal.append(self.full_store)
+
+    def _write_store(self, sequence: int):
+
+        temp_file = f'{self.store_file}.tmp'
+
+        with open(temp_file, 'wb') as output_file:
+            write_store_file(output_file, self.full_store,
+                             self._unloaded_sections(), sequence)
+            output_file.flush()
+            os.fsync(output_file.fileno())
+            size = output_file.tell()
+
+        os.replace(temp_file, self.store_file)
+        log.info(f'Save store: store written to {self.store_file} and is {size} bytes')
+
+    def _reap_save(self, wait: bool) -> bool:
+        """Checks on the background save, if there is one
+
+        Called from _tick, so the save is reaped and its result logged soon
+        after it exits. Once it has written the store, the journal segments
+        it includes are removed.
+
+        Returns:
+            False if the save is still running.
+
+        """
+
+        if self._save_process is None:
+            return True
+
+        (pid, segment) = self._save_process
+        (finished, status) = os.waitpid(pid, 0 if wait else os.WNOHANG)
+        if not finished:
+            return False
+
+        self._save_process = None
+
+        if os.waitstatus_to_exitcode(status) == 0:
+            log.debug(f'Save store: Background save {pid} completed')
+            if segment is not None:
+                self.journal.remove_segments(segment)
+        else:
+            log.error(f'Save store: Background save exited with status '
+                      f'{os.waitstatus_to_exitcode(status)}')
+
+        return True
+
+    def load_store(self):
+        if not self.store_file:
+            log.info("Load store: Persistence not enabled.")
+            return
+
+        try:
+            with open(self.store_file, 'rb') as input_file:
+                if is_store_file(input_file):
+                    self.store_sections = StoreFile(input_file)
+                    self.store_sequence = self.store_sections.sequence
+                    log.info(f'Load store: Store file {self.store_file} has '
+                             f'{len(self.store_sections.sections)} '
+                             f'section(s), loaded when first used.')
                     return
 
-            # Combine this new block with whatever was left from the last block
-            # (if any), and process any complete syslog records within it
+                # Written before the store file had sections
 
-            data = last + block
+                self.full_store = pickle.load(input_file)
+                try:
+                    self.store_sequence = pickle.load(input_file)
+                except EOFError:
+                    # Written before the store had a journal
+                    self.store_sequence = 0
+                log.info(f'Load store: Store loaded from file '
+                         f'{self.store_file}.')
+        except FileNotFoundError:
+            log.info(
+                f'Load store: Store file {self.store_file} does not exist. '
+                f'Initializing new store')
+
+    def from_file(self, input_file: BinaryIO, output_file: BinaryIO = None):
+        """ Processes saved syslog data from a capture file rather than network
+
+        Also supports writing to a capture file. Combined with the record_filter
+        argument in the constructor, this provides rudimentary functionality to
+        edit capture files by reading from one and writing to another, while
+        stripping som packets.
 
-            if not data:
-                # no data to proces, all done
+        Args:
+            input_file: File object of readable binary file
+            output_file: File object of writable binary file
+
+        """
+
+        stream = SyslogStream(self, getattr(input_file, 'name', None))
+        self.output_file = output_file
+
+        while True:
+            nbytes = input_file.readinto(stream.get_buffer())
+            if not nbytes:
+                return
+
+            if not stream.buffer_updated(nbytes):
+                self.processor.dispatch_event(
+                    SimpleError({'message': stream.error}))
+                return
+
+    def from_mmap(self, input_file: BinaryIO, output_file: BinaryIO = None):
+        """ Processes a capture file by memory mapping it
+
+        Like from_file, but the capture file is scanned in place rather than
+        read in blocks. Files that cannot be memory mapped (empty files, pipes)
+        are processed by from_file instead.
+
+        Args:
+            input_file: File object of readable binary file
+            output_file: File object of writable binary file
+
+        """
+
+        try:
+            mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            log.debug(f'Cannot memory map {input_file}: {e}. Reading it '
+                      f'instead')
+            self.from_file(input_file, output_file)
+            return
+
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+        stream = SyslogStream(self, getattr(input_file, 'name', None))
+        self.output_file = output_file
+
+        size = len(mapped)
+        start_records = self.record_num
+        start = time.perf_counter()
+
+        with mapped:
+            if not stream.process_buffer(mapped):
+                self.processor.dispatch_event(
+                    SimpleError({'message': stream.error}))
+
+        elapsed = time.perf_counter() - start
+        records = self.record_num - start_records
+        log.info(f'Replayed {records} records from {size} bytes in '
+                 f'{elapsed:.3f} seconds '
+                 f'({records / elapsed if elapsed else 0:.0f} records/sec)')
+
+    def listening_socket(self, host, port) -> socket.socket:
+        """Returns a TCP socket listening on host and port, for listen_single
+
+        The socket stays open while a connection is handled, and is not
+        selected on until it is done. With SO_REUSEPORT, the kernel may give
+        it new connections meanwhile. They are queued in its backlog until
+        then, rather than reset, so the backlog is as large as allowed.
+
+        """
+
+        server_socket = socket.socket()
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((host, port))
+
+        server_socket.listen(socket.SOMAXCONN if self.reuse_port else 1)
+        server_socket.setblocking(False)
+
+        return server_socket
+
+    def handle_connection(self, server_socket: socket.socket,
+                          output_file: BinaryIO = None):
+
+        (host, port) = server_socket.getsockname()[0:2]
+        log.info(f'Server listening on {host}:{port}')
+
+        while True:
+            timeout = self._seconds_remaining()
+            readable, writable, errored = select.select(
+                [server_socket], [], [], timeout)
+
+            self._tick(self.clock.now())
+
+            if not readable:
+                continue
+
+            conn, (remote_host, remote_port) = server_socket.accept()
+            log.info(f'Connection from: {remote_host}:{remote_port}')
+            break
+
+        stream = SyslogStream(self, f'{remote_host}:{remote_port}')
+
+        self.output_file = output_file
+
+        while True:
+            timeout = self._seconds_remaining()
+            # Nonblocking reads, for the same reason.
+            readable, writable, errored = select.select(
+                [conn], [], [], timeout)
+
+            self._tick(self.clock.now())
+
+            if not readable:
+                continue
+
+            # Otherwise, read
+
+            nbytes = conn.recv_into(stream.get_buffer())
+
+            if not nbytes:
+                log.debug("read block evaluated false")
                 break
 
-            last = self._process_block(data)
+            if not stream.buffer_updated(nbytes):
+                self.processor.dispatch_event(
+                    SimpleError({'message': stream.error}))
+                return
 
     def listen_single(self, output_file: BinaryIO = None):
 
@@ -450,77 +1504,323 @@ class SyslogServer:
             host = socket.gethostname()
         # GlobalConfig.debug_log()
 
+        server_socket = self.listening_socket(host, port)
+
         while True:
             try:
-                self.handle_connection(host, port, output_file)
+                self.handle_connection(server_socket, output_file)
             except KeyboardInterrupt:
-                self.save_store()
+                self.save_store(background=False)
                 break
 
+        server_socket.close()
 
-    @staticmethod
-    def _seconds_remaining():
-        """Calculate the number of seconds until the minute rolls over"""
+    def listen_async(self, output_file: BinaryIO = None):
 
-        now = datetime.now()
+        """ Run an asyncio TCP network listener and process syslog records
 
-        then = (now + timedelta(minutes=1)).replace(second=0)
-        value = (then-now).seconds
+        Unlike listen_single, this serves any number of simultaneous
+        connections. Each connection has its own framing buffer and trailer
+        discovery, and all of them feed the same modules.
 
-        return value
+        Args:
+            output_file:  Binary file open for writing to save received data
 
-    def _tick(self, now: datetime):
-        """Processes a tick of the clock.
+        """
+
+        host = RuntimeConfig.get(f'{self.ConfigModuleName}.listen_address')
+        port = RuntimeConfig.get(f'{self.ConfigModuleName}.listen_port')
+
+        self.output_file = output_file
+
+        try:
+            asyncio.run(self._serve_async(host, port))
+        except KeyboardInterrupt:
+            self.save_store(background=False)
+
+    def handle_datagrams(self, host, port, output_file: BinaryIO = None):
+
+        batch_size = RuntimeConfig.get(
+            f'{self.ConfigModuleName}.udp_batch_size')
+        max_size = RuntimeConfig.get(f'{self.ConfigModuleName}.udp_max_size')
+        receive_buffer = RuntimeConfig.get(
+            f'{self.ConfigModuleName}.udp_receive_buffer')
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server_socket:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                server_socket.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if receive_buffer:
+                server_socket.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+            server_socket.bind((host, port))
+            server_socket.setblocking(False)
+
+            log.info(f'Server listening on {host}:{port} (UDP)')
+
+            # One byte larger than the largest accepted datagram, so that
+            # oversize (truncated) datagrams can be detected.
+
+            buffers = [bytearray(max_size + 1) for _ in range(batch_size)]
+            views = [memoryview(buffer) for buffer in buffers]
+            lengths = [0] * batch_size
+
+            # Every datagram is one record. They are written to the capture
+            # file octet-counted, so that records containing newlines survive
+            # replay.
 
-        If a minute boundary is crossed, it performs its per-minute
-        tasks:
+            stream = SyslogStream(self, f'{host}:{port}')
+            stream.octet_counting = True
 
-        - Determine if it's time to save store
-        - Run any appropriate task handlers if they were defined by the module
+            self.output_file = output_file
 
-        This is meant to be called at the top of every minute.
+            while True:
+                timeout = self._seconds_remaining()
+                readable, writable, errored = select.select(
+                    [server_socket], [], [], timeout)
+
+                self._tick(self.clock.now())
+
+                if not readable:
+                    continue
+
+                # Drain the socket first, then process the batch. This empties
+                # the kernel receive queue as quickly as possible.
+
+                count = 0
+                while count < batch_size:
+                    try:
+                        nbytes, address = server_socket.recvfrom_into(
+                            buffers[count])
+                    except BlockingIOError:
+                        break
+
+                    if nbytes > max_size:
+                        log.debug(f'Dropped oversize datagram from {address}')
+                        self.dropped += 1
+                        continue
+
+                    # Some senders terminate datagrams with a newline
+
+                    if nbytes and buffers[count][nbytes - 1] == 10:
+                        nbytes -= 1
+
+                    if not nbytes:
+                        self.dropped += 1
+                        continue
+
+                    lengths[count] = nbytes
+                    count += 1
+
+                for index in range(count):
+                    self._process_record(
+                        bytes(views[index][0:lengths[index]]), stream)
+
+                self._block_processed()
+
+    def listen_udp(self, output_file: BinaryIO = None):
+
+        """ Run a UDP network listener and process syslog records
+
+        Every datagram is a single syslog record. Datagrams are read in
+        batches of up to syslog_server.udp_batch_size each time the socket
+        becomes readable.
+
+        Args:
+            output_file:  Binary file open for writing to save received data
 
         """
 
-        # Check to make sure its necessary. This makes it zero risk to be run
-        # from anywhere, even if it may have been called already for this
-        # minute.
+        host = RuntimeConfig.get(f'{self.ConfigModuleName}.listen_address')
+        port = RuntimeConfig.get(f'{self.ConfigModuleName}.listen_port')
+
+        try:
+            self.handle_datagrams(host, port, output_file)
+        except KeyboardInterrupt:
+            self.save_store(background=False)
+
+    def listen(self, output_file: BinaryIO = None):
 
-        last_minute = int(self.last_tick.timestamp() / 60)
-        this_minute = int(now.timestamp() / 60)
+        """ Run the network listener selected by syslog_server.listen_mode
 
-        if this_minute == last_minute:
-            log.debug('Tick called within the same minute. Ignoring.')
-            return
+        Args:
+            output_file:  Binary file open for writing to save received data
+
+        """
+
+        mode = RuntimeConfig.get(f'{self.ConfigModuleName}.listen_mode')
+        ring_size = RuntimeConfig.get(
+            f'{self.ConfigModuleName}.ring_buffer_size')
+
+        if ring_size:
+            self.listen_ring(mode, ring_size, output_file)
+        else:
+            self.listen_mode(mode, output_file)
+
+    def listen_mode(self, mode: str, output_file: BinaryIO = None):
+
+        """ Run the network listener for a listen mode
+
+        Args:
+            mode: single, async or udp
+            output_file:  Binary file open for writing to save received data
+
+        """
+
+        if mode == 'async':
+            self.listen_async(output_file)
+        elif mode == 'udp':
+            self.listen_udp(output_file)
+        elif mode == 'single':
+            self.listen_single(output_file)
+        else:
+            raise ValueError(f'Unknown listen mode: {mode}')
+
+    def listen_ring(self, mode: str, size: int,
+                    output_file: BinaryIO = None):
+
+        """ Read from the network in a separate process, through a ring buffer
+
+        A reader process runs the network listener for the mode, and puts
+        the records it receives in a shared memory ring buffer of size bytes.
+        This process takes them from the ring and processes them, so network
+        reads never wait for the modules or event handlers. If the ring is
+        full, the reader discards records rather than wait for room.
+
+        Args:
+            mode: single, async or udp
+            size: Size of the ring buffer in bytes
+            output_file:  Binary file open for writing to save received data
+
+        """
+
+        self.ring = RecordRing(size)
+        (notify_read, notify_write) = os.pipe()
+        os.set_blocking(notify_write, False)
+
+        pid = os.fork()
+        if pid == 0:
+            # Reader process. The processing side stops it.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            os.close(notify_read)
+            reader = RingReader(self.processor, self.ring, notify_write)
+            try:
+                reader.listen_mode(mode)
+            finally:
+                os._exit(0)
+
+        os.close(notify_write)
+        log.info(f'Reading from the network in process {pid}, through a '
+                 f'{size} byte ring buffer')
+
+        # Records are written to the capture file octet counted, as they are
+        # for UDP
+
+        stream = SyslogStream(self, 'ring buffer')
+        stream.octet_counting = True
+        self.output_file = output_file
+
+        try:
+            while True:
+                readable, writable, errored = select.select(
+                    [notify_read], [], [], self._seconds_remaining())
+
+                self._tick(self.clock.now())
+
+                if readable and not os.read(notify_read, 4096):
+                    log.error('Network reader process exited')
+                    break
+
+                self._consume_ring(stream)
+
+        except KeyboardInterrupt:
+            self.save_store(background=False)
+
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            os.close(notify_read)
+
+            self._consume_ring(stream)
+            self.dropped += self.ring.overflows + self.ring.dropped
+
+            log.info(f'Ring buffer high water mark {self.ring.high_water} '
+                     f'bytes, {self.ring.overflows} overflow(s)')
+
+    def _consume_ring(self, stream: SyslogStream):
+        for data in self.ring.records():
+            self._process_record(data, stream)
+        self._block_processed()
+
+    async def _serve_async(self, host, port):
+
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: SyslogProtocol(self), host, port, reuse_address=True,
+            reuse_port=self.reuse_port)
+
+        log.info(f'Server listening on {host}:{port}')
+
+        async with server:
+            while True:
+                await asyncio.sleep(self._seconds_remaining())
+                self._tick(self.clock.now())
+
+
+    def _seconds_remaining(self):
+        """Calculate the number of seconds until the next timer is due"""
+
+        remaining = 60
+
+        for scheduler in (self.scheduler, self.store_scheduler):
+            due = scheduler.next_due()
+            if due is not None:
+                remaining = min(
+                    remaining, (due - scheduler.clock.now()).total_seconds())
+
+        return max(remaining, 0)
+
+    def _tick(self, now: datetime):
+        """Processes a tick of the clock.
+
+        Reaps the background save once it has exited, and runs the timers
+        that are due: saving the persistence store, and the timers of the
+        modules. This is cheap when no timer is due, so it is safe to call
+        from anywhere, as often as needed.
 
-        self.last_tick = now
+        Args:
+            now: Time of the server clock, for the module timers. The
+                persistence timers always run on the wall clock.
+
+        """
+
+        self._reap_save(wait=False)
+        self.scheduler.run_due(now)
+        self.store_scheduler.run_due(self.store_scheduler.clock.now())
 
-        # check to see if it's time to save the persistence store
+    def _register_timers(self):
+        """Adds the persistence timers and the modules' timers
 
-        if now.minute % self.save_store_interval == 0:
-            self.save_store()
+        The persistence timers (store save, journal, database commits) go on
+        the wall clock scheduler, so that a replay does not save for every
+        interval of record time. The module timers follow the server clock.
 
-        # Setup array of actions that are valid for this minute
+        """
 
-        actions = [
-            [True, 'timer_handler_minute'],
-            [True, f'timer_handler_{now.hour}_{now.minute}'],
-            [now.minute % 5 == 0, 'timer_handler_5_minutes'],
-            [now.minute % 10 == 0, 'timer_handler_10_minutes'],
-            [now.minute % 15 == 0, 'timer_handler_15_minutes'],
-            [now.minute % 30 == 0, 'timer_handler_30_minutes'],
-            [now.minute == 0,  'timer_handler_1_hour'],
+        self.store_scheduler.every(self.save_store_interval * 60,
+                                   lambda now: self.save_store())
 
-        ]
+        if self.journal is not None:
+            self.store_scheduler.every(
+                self.journal_interval, lambda now: self._append_journal())
 
-        # Go through the modules and call the handlers if they are defined
+        if self.databases:
+            self.store_scheduler.every(self.store_commit_interval,
+                                       lambda now: self.commit_databases())
 
         for module in self.modules:
-            for (flag, method) in actions:
-                if flag:
-                    handler = getattr(module, method, None)
-                    if callable(handler):
-                        handler(now)
+            module.register_timers(self.scheduler)
 
     def discover_trailer(self, block):
         raw_block = SyslogRecord.decode_from_raw(block)
@@ -540,17 +1840,93 @@ class SyslogServer:
         # Default trailer
         return self.default_syslog_trailer
 
-    def _process_block(self, data):
+    def filter_statistics(self):
+        """Dispatches the pre-parse filter statistics, if it is in use"""
 
-        while True:
-            pos = data.find(self.syslog_trailer)
-            if pos == -1:
-                return data
-            self._process_record(data[0:pos])
-            data = data[pos + 1:]
+        if self.allow_appnames is None and self.allow_hostnames is None:
+            return
 
-    def _process_record(self, data):
-        record = self.record(data)
+        per_appname = sorted(self.rejected.items(), key=lambda x: -x[1])
+        if self.rejected_other:
+            per_appname.append(('other', self.rejected_other))
+
+        e = SyslogFilterStatsEvent({
+            'rejected': sum(self.rejected.values()) + self.rejected_other,
+            'appnames': ', '.join(
+                f'{appname}={count}' for appname, count in per_appname)
+        })
+        e.system = self.ConfigModuleName
+        self.processor.dispatch_event(e)
+
+    def ring_statistics(self):
+        """Dispatches the ring buffer statistics, if it was in use"""
+
+        if self.ring is None:
+            return
+
+        e = SyslogRingStatsEvent({
+            'size': self.ring.size,
+            'high_water': self.ring.high_water,
+            'overflows': self.ring.overflows
+        })
+        e.system = self.ConfigModuleName
+        self.processor.dispatch_event(e)
+
+        self.ring.close()
+        self.ring = None
+
+    def _accept(self, data: bytes) -> bool:
+        """Checks the raw record against the allowed appnames and hostnames
+
+        This runs before the record is decoded or parsed, and counts the
+        rejected records per appname. At most MAX_REJECTED_APPNAMES appnames
+        are counted, so a sender making up appnames can't grow the counts
+        without bound. Records with other appnames are counted together.
+
+        """
+
+        fields = raw_header_fields(data)
+        if fields is None:
+            # Let the record class report the error
+            return True
+
+        hostname, appname = fields
+        if ((self.allow_appnames is None
+             or appname.lower() in self.allow_appnames)
+                and (self.allow_hostnames is None
+                     or hostname.lower() in self.allow_hostnames)):
+            return True
+
+        key = appname.decode('utf-8', errors='replace')
+        count = self.rejected.get(key)
+        if count is not None:
+            self.rejected[key] = count + 1
+        elif len(self.rejected) < MAX_REJECTED_APPNAMES:
+            self.rejected[key] = 1
+        else:
+            self.rejected_other += 1
+        return False
+
+    def _follow_record_time(self, timestamp: datetime | None):
+        """Advances a ReplayClock to a record's time, running due timers"""
+
+        if timestamp is None:
+            return
+
+        first = self.clock.time is None
+        self.clock.advance(timestamp)
+
+        if first:
+            # The timers were scheduled from the real time
+            self.scheduler.reset(self.clock.now())
+        else:
+            self._tick(self.clock.now())
+
+    def _block_processed(self):
+        """Called after each block of received records has been processed"""
+        return
+
+    def _process_record(self, data, stream: SyslogStream):
 
         if self.output_file is not None:
             # Write record to capture file
@@ -560,15 +1936,152 @@ class SyslogServer:
                 # not to be written.
                 process_record = self.record_filter[self.record_num]
             if process_record:
-                self.output_file.write(data + self.syslog_trailer)
+                self.output_file.write(stream.frame(data))
 
         self.record_num += 1
+
+        if (self.allow_appnames is not None
+                or self.allow_hostnames is not None):
+            if not self._accept(data):
+                return
+
+        self._handle_record(data)
+
+    def _handle_record(self, data: bytes):
+        """Parses a raw record and passes it to the modules that want it"""
+
+        record = self.record(data)
+
+        # A LazySyslogRecord finds a bad timestamp or structured data when it
+        # decodes them, so it is decoded before it is passed to any module.
+        # Records that no module wants are not decoded.
+
+        modules = ()
         if not record.error:
-            for module in self.modules:
-                module.handle_record(record)
-        else:
+            modules = self.router.route(record.appname)
+            if modules:
+                record.decode()
+
+        if record.error:
             self.processor.dispatch_event(
                 SimpleError({'message': 'Error processing record'}))
+            return
+
+        if self.clock.follows_records:
+            self._follow_record_time(record.timestamp)
+
+        for module in modules:
+            module.handle_record(record)
+
+
+class SyslogProtocol(asyncio.BufferedProtocol):
+
+    """ asyncio protocol for a syslog connection served by listen_async
+
+    asyncio receives data directly into the connection's SyslogStream buffer.
+
+    Args:
+        server: SyslogServer that processes the records from this connection
+
+    """
+
+    def __init__(self, server: SyslogServer):
+        self.server = server
+        self.transport = None
+        self.stream = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        remote_host, remote_port = transport.get_extra_info('peername')[0:2]
+        log.info(f'Connection from: {remote_host}:{remote_port}')
+
+        self.transport = transport
+        self.stream = SyslogStream(self.server, f'{remote_host}:{remote_port}')
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.stream.get_buffer()
+
+    def buffer_updated(self, nbytes: int):
+
+        self.server._tick(self.server.clock.now())
+
+        if not self.stream.buffer_updated(nbytes):
+            self.server.processor.dispatch_event(
+                SimpleError({'message': self.stream.error}))
+            self.transport.close()
+
+    def connection_lost(self, exc: Exception | None):
+        if exc is not None:
+            log.info(f'Connection from {self.stream.name} failed: {exc}')
+        log.info(f'Connection from {self.stream.name} closed')
+
+
+class RingReader(SyslogServer):
+
+    """ The network reader process of SyslogServer.listen_ring
+
+    Runs a network listener with no modules, and puts every record it
+    receives into the ring buffer rather than processing it. After each block
+    of records, a byte is written to notify_fd to wake up the processing
+    side.
+
+    Args:
+        processor: Instance of EventProcessor, for framing errors
+        ring: Ring buffer shared with the processing side
+        notify_fd: Non-blocking file descriptor to notify the processing side
+
+    """
+
+    def __init__(self, processor: EventProcessor, ring: RecordRing,
+                 notify_fd: int):
+        super().__init__([], processor)
+        self.ring = ring
+        self.notify_fd = notify_fd
+        self.skip_save_store = True
+
+    def _process_record(self, data, stream: SyslogStream):
+        self.record_num += 1
+        self.ring.put(data)
+
+    def _block_processed(self):
+        self.ring.dropped = self.dropped
+        try:
+            os.write(self.notify_fd, b'\0')
+        except BlockingIOError:
+            # The processing side has yet to read earlier notifications
+            pass
+
+
+class SyslogRingStatsEvent(StatsEvent):
+
+    schema = [
+        ['size', 'Ring buffer size:'],
+        ['high_water', 'High water mark:'],
+        ['overflows', 'Records discarded when full:'],
+    ]
+    templates = {
+        'text/plain': {
+            'summary': 'Statistics: Ring buffer of ${size} bytes reached a high water mark of ${high_water} bytes, ${overflows} record(s) discarded when full'
+        },
+        'text/html': {
+            'summary': 'Statistics: Ring buffer of <strong>${size}</strong> bytes reached a high water mark of <strong>${high_water}</strong> bytes, <strong>${overflows}</strong> record(s) discarded when full'
+        }
+    }
+
+
+class SyslogFilterStatsEvent(StatsEvent):
+
+    schema = [
+        ['rejected', 'Records rejected:'],
+        ['appnames', 'Rejected records per appname:'],
+    ]
+    templates = {
+        'text/plain': {
+            'summary': 'Statistics: ${rejected} record(s) rejected by the pre-parse filter (${appnames})'
+        },
+        'text/html': {
+            'summary': 'Statistics: <strong>${rejected}</strong> record(s) rejected by the pre-parse filter (${appnames})'
+        }
+    }
 
 
 class SyslogStatsEvent(StatsEvent):
@@ -577,13 +2090,18 @@ class SyslogStatsEvent(StatsEvent):
         ['start', 'Session started:'],
         ['end', 'Session ended:'],
         ['duration', 'Session duration:'],
+        ['records', 'Records received:'],
+        ['dropped', 'Records dropped:'],
+        ['unclaimed', 'Records no module wanted:'],
+        ['rate', 'Records per second:'],
     ]
+
     templates = {
         'text/plain': {
-            'summary': 'Statistics: Session started at ${start}, ended at ${end}, with a duration of ${duration}'
+            'summary': 'Statistics: Session started at ${start}, ended at ${end}, with a duration of ${duration}, ${records} record(s) received (${rate} per second) and ${dropped} dropped'
         },
         'text/html': {
-            'summary': 'Statistics: Session started at <strong>${start}</strong>, ended at <strong>${end}</strong>, with a duration of <strong>${duration}</strong>'
+            'summary': 'Statistics: Session started at <strong>${start}</strong>, ended at <strong>${end}</strong>, with a duration of <strong>${duration}</strong>, <strong>${records}</strong> record(s) received (<strong>${rate}</strong> per second) and <strong>${dropped}</strong> dropped'
         }
 
     }
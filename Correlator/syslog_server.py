@@ -7,10 +7,13 @@ from datetime import datetime
 from Correlator.config_store import RuntimeConfig
 from Correlator.app_config import ApplicationConfig
 from Correlator.Event.core import EventProcessor, EventSeverity
-from Correlator.syslog import (RawSyslogRecord, SyslogRecord, SyslogServer,
-                               SyslogStatsEvent)
+from Correlator.sharded import ShardedSyslogServer
+from Correlator.syslog import (LazySyslogRecord, RawSyslogRecord,
+                               SyslogRecord, SyslogServer, SyslogStatsEvent,
+                               fork_listeners)
 from Correlator.util import (setup_root_logger, capture_filename, Instance,
-                             format_timestamp, prefix_run_dir, setup_keyring)
+                             format_timestamp, prefix_run_dir, setup_keyring,
+                             ReplayClock)
 
 
 class SyslogServerCLI:
@@ -20,8 +23,20 @@ class SyslogServerCLI:
 
     @staticmethod
     def syslog_record_model():
+        if RuntimeConfig.get(f'{SyslogServer.ConfigModuleName}.lazy_records'):
+            return LazySyslogRecord
         return SyslogRecord
 
+    @staticmethod
+    def worker_filename(file_name: str, worker: int | None) -> str:
+        """Adds the listener process number to a file name, if there is one"""
+
+        if worker is None:
+            return file_name
+
+        (root, ext) = os.path.splitext(file_name)
+        return f'{root}.{worker}{ext}'
+
     @staticmethod
     def trailer_discovery_method(
             raw_record: RawSyslogRecord) -> bytes | None:
@@ -210,12 +225,25 @@ class SyslogServerCLI:
                     f'credential store')
             self.quit()
 
+        # Fork the listener processes, if using more than one. Each has its
+        # own capture and store file.
+
+        worker = None
+        workers = RuntimeConfig.get(
+            f'{SyslogServer.ConfigModuleName}.listen_workers')
+
+        if workers > 1 and not cmd_args.read_file and not cmd_args.config:
+            worker = fork_listeners(workers)
+            if worker is None:
+                self.quit()
+
         # Prepare output file, if using
 
         output_fd = None
 
         if cmd_args.write_file:
-            filename = prefix_run_dir(cmd_args.write_file)
+            filename = self.worker_filename(
+                prefix_run_dir(cmd_args.write_file), worker)
 
             if os.path.exists(filename):
                 self.quit(f'{filename} already exists.')
@@ -227,7 +255,8 @@ class SyslogServerCLI:
         store_filename = None
 
         if cmd_args.store_file:
-            store_filename = prefix_run_dir(cmd_args.store_file)
+            store_filename = self.worker_filename(
+                prefix_run_dir(cmd_args.store_file), worker)
 
         if cmd_args.config:
             RuntimeConfig.dump_to_log(debug=False)
@@ -236,11 +265,24 @@ class SyslogServerCLI:
         else:
             RuntimeConfig.dump_to_log()
 
-        server = SyslogServer(stack.modules,
-                              stack.processor,
-                              record=self.syslog_record_model(),
-                              store_file=store_filename,
-                              discovery_method=self.trailer_discovery_method)
+        server_args = {
+            'record': self.syslog_record_model(),
+            'store_file': store_filename,
+            'discovery_method': self.trailer_discovery_method
+        }
+
+        if cmd_args.read_file and RuntimeConfig.get(
+                f'{SyslogServer.ConfigModuleName}.replay_clock'):
+            server_args['clock'] = ReplayClock()
+
+        shards = RuntimeConfig.get(f'{SyslogServer.ConfigModuleName}.shards')
+
+        if shards > 1:
+            server = ShardedSyslogServer(stack.modules, stack.processor,
+                                         shards=shards, **server_args)
+        else:
+            server = SyslogServer(stack.modules, stack.processor,
+                                  **server_args)
 
         module_name = server.ConfigModuleName
 
@@ -249,21 +291,29 @@ class SyslogServerCLI:
         if cmd_args.read_file:
             # Replay from capture file
             self.log.info(f'Reading from capture file {cmd_args.read_file}')
-            server.from_file(open(cmd_args.read_file, 'rb'))
+            server.from_mmap(open(cmd_args.read_file, 'rb'))
 
         else:
-            server.listen_single(output_file=output_fd)
+            server.listen(output_file=output_fd)
 
         end = datetime.now()
+        seconds = (end - start).total_seconds()
 
         for module in stack.modules:
             module.statistics()
 
+        server.filter_statistics()
+        server.ring_statistics()
+
         e = SyslogStatsEvent(
             {
                 'start': format_timestamp(start),
                 'end': format_timestamp(end),
-                'duration': str(end - start)
+                'duration': str(end - start),
+                'records': server.record_num,
+                'dropped': server.dropped,
+                'unclaimed': server.router.unclaimed,
+                'rate': round(server.record_num / seconds if seconds else 0, 1)
             })
         e.system = module_name
         stack.processor.dispatch_event(e)
@@ -1,19 +1,58 @@
 import argparse
+import heapq
 import logging
 import os
 import re
 import sys
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
+from typing import Callable
 
 import keyring
 
 from Correlator.Event.core import Event
-from Correlator.config_store import RuntimeConfig
+from Correlator.config_store import ConfigType, RuntimeConfig
 
 DEFAULT_ROTATE_KEEP = 10
 MAX_SUMMARY = 128
 MAX_BREAK_SEARCH = 10
 
+# Timer handler methods that Module.register_timers looks for, and their
+# interval in seconds. Modules may also define timer_handler_{hour}_{minute}.
+
+TIMER_HANDLERS = [
+    (60, 'timer_handler_minute'),
+    (300, 'timer_handler_5_minutes'),
+    (600, 'timer_handler_10_minutes'),
+    (900, 'timer_handler_15_minutes'),
+    (1800, 'timer_handler_30_minutes'),
+    (3600, 'timer_handler_1_hour'),
+]
+
+# Configuration every module has
+
+ModuleConfig = [
+    {
+        'store_backend': {
+            'default': 'pickle',
+            'desc': 'Where the dict fields of the module store are kept. '
+                    'pickle keeps them in memory, and saves them with the '
+                    'rest of the persistence store. sqlite keeps them in an '
+                    'SQLite database next to the store file, with the most '
+                    'recently used entries cached in memory.',
+            'type': ConfigType.STRING
+        }
+    },
+    {
+        'store_cache_entries': {
+            'default': 10000,
+            'desc': 'With the sqlite store backend, the number of entries of '
+                    'each dict field of the module store to cache in memory.',
+            'type': ConfigType.INTEGER
+        }
+    }
+]
+
 log = logging.getLogger(__name__)
 
 
@@ -66,13 +105,27 @@ class Module:
 
     description: str = ''
 
+    appnames: set[str] | None = None
+    """Lower case appnames of the records this module processes, or None for
+    all records. Modules that need more than a set can override
+    wants_appname instead."""
+
+    store_timestamps: dict[str, Callable] = {}
+    """Dict fields of the store whose values have a timestamp, and a function
+    that returns it. With the sqlite store backend, these fields are indexed
+    by timestamp, so their older_than method is a range scan."""
+
     def __init__(self, module_name):
         self._processor = None
         self._store = None
+        self._store_loader = None
         self.model = None
         self.module_name = module_name
+        self.clock = WallClock()
+        self.key_router = None
         self.log = logging.getLogger(f'{module_name}-module')
         self.configuration_prefix = f'module.{self.module_name}.'
+        self.add_config(ModuleConfig)
 
     @property
     def event_processor(self):
@@ -84,11 +137,24 @@ class Module:
 
     @property
     def store(self):
+        if self._store is None and self._store_loader is not None:
+            (loader, self._store_loader) = (self._store_loader, None)
+            loader()
         return self._store
 
     @store.setter
     def store(self, value):
         self._store = value
+        self._store_loader = None
+
+    def defer_store(self, loader: Callable[[], None]):
+        """Sets a function that sets the store, for when it is first used
+
+        The server uses this to load each module's store on demand.
+
+        """
+        self._store = None
+        self._store_loader = loader
 
     def dispatch_event(self, event: Event):
 
@@ -101,8 +167,97 @@ class Module:
     def post_init_store(self):
         return
 
+    def keyed_call(self, key: str, method: str, *args):
+        """Calls one of the module's methods on state kept by a key
+
+        Records are sent to shards by hostname, but some state is kept by
+        another key, such as failed logins by remote address. With shards,
+        that state is kept by the shard the key maps to (see partition_store),
+        and key_router sends the call there. Otherwise the method is called
+        here and now. The arguments are pickled when the call is sent.
+
+        """
+
+        if self.key_router is not None and self.key_router(
+                self, key, method, args):
+            return
+        getattr(self, method)(*args)
+
+    def register_timers(self, scheduler: 'Scheduler'):
+        """Adds this module's timers to the scheduler, once at startup
+
+        By default, the timer handler methods the module defines are added:
+        the names in TIMER_HANDLERS, and timer_handler_{hour}_{minute}, which
+        is called daily at that time. Modules can override this to add
+        timers of any interval, including less than a minute.
+
+        """
+
+        for (seconds, name) in TIMER_HANDLERS:
+            handler = getattr(self, name, None)
+            if callable(handler):
+                scheduler.every(seconds, handler)
+
+        for name in dir(self):
+            m = re.fullmatch(r'timer_handler_(\d+)_(\d+)', name)
+            if not m:
+                continue
+            handler = getattr(self, name)
+            if callable(handler):
+                (hour, minute) = (int(m.group(1)), int(m.group(2)))
+                if hour < 24 and minute < 60:
+                    scheduler.daily(hour, minute, handler)
+                else:
+                    self.log.warning(f'{name} is not a valid time of day. '
+                                     f'Ignoring it.')
+
+    def partition_store(self, store, count: int,
+                        shard_of: Callable[[str], int]) -> list:
+        """Splits the store into one store per shard, for sharded processing
+
+        shard_of returns the shard that records from a hostname are sent to.
+        By default the first shard keeps the whole store, and the others
+        start with an empty one.
+
+        """
+        return [store] + [self.model() for _ in range(count - 1)]
+
+    def merge_stores(self, stores: list):
+        """Combines the stores of all shards back into one store
+
+        Numbers are added together, dicts are updated and lists are extended.
+        Anything else keeps the first value that is not None.
+
+        """
+
+        merged = self.model()
+
+        for store in stores:
+            for key, value in vars(store).items():
+                current = getattr(merged, key, None)
+                if (isinstance(value, (int, float))
+                        and not isinstance(value, bool)
+                        and isinstance(current, (int, float))):
+                    setattr(merged, key, current + value)
+                elif isinstance(value, dict) and isinstance(current, dict):
+                    current.update(value)
+                elif isinstance(value, list) and isinstance(current, list):
+                    current.extend(value)
+                elif current is None:
+                    setattr(merged, key, value)
+
+        return merged
+
+    def wants_appname(self, appname: str) -> bool:
+        """Returns True if records with this appname are sent to this module
+
+        This is evaluated once per distinct appname, not once per record.
+
+        """
+        return self.appnames is None or appname.lower() in self.appnames
+
     def handle_record(self, record):
-        if self._store is None:
+        if self.store is None:
             raise ValueError('No Store!')
         self.process_record(record)
 
@@ -131,6 +286,220 @@ class Module:
             return None
 
 
+class ModuleRouter:
+    """Dispatch index from record appname to the modules that want it
+
+    The modules interested in an appname are determined the first time the
+    appname is seen, and are remembered from then on. Records that no module
+    wants are counted, rather than being passed to every module.
+
+    At most max_cache appnames are remembered, so a sender making up
+    appnames can't grow the index without bound. The appnames the modules
+    name are remembered first. Others beyond the limit are matched against
+    the modules every time.
+
+    Args:
+        modules: List of Correlator modules in the stack
+        max_cache: Most appnames to remember
+
+    """
+
+    def __init__(self, modules: list[Module], max_cache: int = 4096):
+        self.modules = modules
+        self.max_cache = max_cache
+        self.unclaimed = 0
+        self._index: dict[str, list[Module]] = {}
+
+        # Records with no appname only go to the modules that want every
+        # record
+
+        self._no_appname = [module for module in modules
+                            if module.appnames is None]
+
+        for module in modules:
+            for appname in module.appnames or []:
+                self.route(appname)
+
+    def route(self, appname: str | None) -> list[Module]:
+        """Returns the modules that want records with this appname
+
+        Records with no appname at all only go to the modules whose appnames
+        is None.
+
+        """
+
+        if appname is None:
+            modules = self._no_appname
+        else:
+            modules = self._index.get(appname)
+            if modules is None:
+                modules = [module for module in self.modules
+                           if module.wants_appname(appname)]
+                if len(self._index) < self.max_cache:
+                    self._index[appname] = modules
+                    log.debug(f'Records with appname {appname} are routed to '
+                              f'{[module.module_name for module in modules]}')
+
+        if not modules:
+            self.unclaimed += 1
+
+        return modules
+
+
+class WallClock:
+    """The clock the server, modules and counters tell the time with
+
+    This one tells the real time.
+
+    """
+
+    follows_records = False
+
+    @staticmethod
+    def now() -> datetime:
+        return datetime.now()
+
+
+class ReplayClock(WallClock):
+    """Clock that tells the time of the records being replayed
+
+    The time is advanced to the timestamp of each record as it is processed,
+    so a capture file replayed at full speed sees the time pass as it did
+    when the records were captured. Until the first record, it tells the
+    real time.
+
+    """
+
+    follows_records = True
+
+    def __init__(self):
+        self.time: datetime | None = None
+
+    def now(self) -> datetime:
+        return self.time if self.time is not None else datetime.now()
+
+    def advance(self, timestamp: datetime):
+        """Moves the time forward to timestamp. It never moves backwards."""
+
+        if self.time is None or timestamp > self.time:
+            self.time = timestamp
+
+
+class Timer:
+    """A callback scheduled by Scheduler
+
+    Interval timers have an interval in seconds, daily timers an hour and
+    minute.
+
+    """
+
+    def __init__(self, callback: Callable[[datetime], None],
+                 interval: float = None, hour: int = None, minute: int = None):
+        self.callback = callback
+        self.interval = interval
+        self.hour = hour
+        self.minute = minute
+        self.due: datetime | None = None
+        self.cancelled = False
+
+    def next_due(self, now: datetime) -> datetime:
+        """Returns the first time this timer is due after now"""
+
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        if self.interval is None:
+            due = midnight.replace(hour=self.hour, minute=self.minute)
+            if due <= now:
+                due += timedelta(days=1)
+            return due
+
+        # Interval timers are aligned to midnight, so a 5 minute timer is
+        # due at 12:00, 12:05, 12:10 and so on.
+
+        elapsed = (now - midnight).total_seconds()
+        return midnight + timedelta(
+            seconds=(elapsed // self.interval + 1) * self.interval)
+
+
+class Scheduler:
+    """Runs callbacks at intervals, or at times of the day
+
+    Timers are kept in a heap ordered by the time they are next due, so
+    run_due only looks at the timers that are due. Timers that are due at the
+    same time run in the order they were added. A timer that was missed
+    more than once (because run_due wasn't called for a while) runs once.
+
+    """
+
+    def __init__(self, clock: WallClock = None):
+        self.clock = clock or WallClock()
+        self._heap = []
+        self._sequence = 0
+
+    def every(self, seconds: float, callback: Callable[[datetime], None],
+              now: datetime = None) -> Timer:
+        """Calls callback(now) every number of seconds, counted from midnight"""
+
+        if seconds <= 0:
+            raise ValueError('Timer interval must be positive')
+
+        return self._add(Timer(callback, interval=seconds), now)
+
+    def daily(self, hour: int, minute: int,
+              callback: Callable[[datetime], None],
+              now: datetime = None) -> Timer:
+        """Calls callback(now) every day at hour:minute"""
+
+        return self._add(Timer(callback, hour=hour, minute=minute), now)
+
+    @staticmethod
+    def cancel(timer: Timer):
+        timer.cancelled = True
+
+    def _add(self, timer: Timer, now: datetime = None) -> Timer:
+        self._push(timer, timer.next_due(now or self.clock.now()))
+        return timer
+
+    def reset(self, now: datetime):
+        """Schedules every timer again, from now. For when the clock jumps."""
+
+        timers = [timer for (due, sequence, timer) in self._heap
+                  if not timer.cancelled]
+        self._heap = []
+
+        for timer in timers:
+            self._push(timer, timer.next_due(now))
+
+    def _push(self, timer: Timer, due: datetime):
+        timer.due = due
+        self._sequence += 1
+        heapq.heappush(self._heap, (due, self._sequence, timer))
+
+    def next_due(self) -> datetime | None:
+        """Returns when the next timer is due, or None if there are none"""
+
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+
+        return self._heap[0][0] if self._heap else None
+
+    def run_due(self, now: datetime) -> int:
+        """Runs every timer that is due at now. Returns how many ran."""
+
+        count = 0
+
+        while self._heap and self._heap[0][0] <= now:
+            (due, sequence, timer) = heapq.heappop(self._heap)
+            if timer.cancelled:
+                continue
+
+            self._push(timer, timer.next_due(now))
+            timer.callback(now)
+            count += 1
+
+        return count
+
+
 def listize(item):
     if isinstance(item, list):
         return item
@@ -223,29 +592,491 @@ def calculate_summary(detail: str):
     return detail[0:MAX_SUMMARY]
 
 
-class CountOverTime:
-    def __init__(self, expiry_seconds: int, store: dict):
-        self.expiry_seconds = expiry_seconds
+class SlidingWindowCounter:
+    """Counts occurrences per identifier within a sliding window of time
+
+    Each identifier has a deque of the times of its occurrences, as float
+    seconds, oldest first. Adding one only drops the times that have left the
+    window from the front, so it is O(1) amortized. The deques are kept in a
+    dict of the module store, so they are persisted with it. Lists of
+    datetimes, as CountOverTime kept, are converted when they are next used.
+
+    Identifiers whose last occurrence has left the window are removed by
+    evict, which pops them from an expiry heap (or uses the timestamp index
+    of the sqlite store backend). With max_identifiers, the least recently
+    counted identifiers beyond it are removed as others are added.
+
+    Args:
+        window_seconds: Length of the window
+        store: dict of identifier to occurrences, from the module store
+        clock: Clock to tell the time with
+        max_identifiers: Most identifiers to keep. 0 means no limit.
+
+    """
+
+    def __init__(self, window_seconds: float, store: dict,
+                 clock: WallClock = None, max_identifiers: int = 0):
+        self.window = window_seconds
         self.store = store
+        self.clock = clock or WallClock()
+        self.max_identifiers = max_identifiers
+
+        self._indexed = hasattr(store, 'older_than')
+        self._heap = []
+        self._sequence = 0
+        self._recent = OrderedDict.fromkeys(store) if max_identifiers else None
+
+        if not self._indexed:
+            self._rebuild()
 
-    def add(self, identifier, timestamp):
-        if identifier not in self.store:
-            self.store[identifier] = [timestamp]
-            return 1
+    @staticmethod
+    def as_times(occurrences) -> deque:
+        """Returns occurrences as a deque of float seconds"""
+
+        if isinstance(occurrences, deque):
+            return occurrences
+        return deque(x.timestamp() if isinstance(x, datetime) else x
+                     for x in occurrences)
 
-        earliest = datetime.now() - timedelta(seconds=self.expiry_seconds)
-        new_store = [x for x in self.store[identifier] if x >= earliest]
-        now = datetime.now()
-        if now > earliest:
-            new_store.append(now)
+    @staticmethod
+    def _last_time(occurrences) -> float:
+        last = occurrences[-1]
+        return last.timestamp() if isinstance(last, datetime) else last
 
-        self.store[identifier] = new_store
+    @staticmethod
+    def last_seen(occurrences) -> datetime | None:
+        """Returns the time of the last occurrence, for the sqlite index"""
 
-        return len(new_store)
+        if not occurrences:
+            return None
+        last = occurrences[-1]
+        return last if isinstance(last, datetime) else (
+            datetime.fromtimestamp(last))
+
+    def _rebuild(self):
+        self._heap = []
+        for (identifier, occurrences) in self.store.items():
+            if occurrences:
+                self._heap.append(
+                    (self._last_time(occurrences) + self.window,
+                     self._next(), identifier))
+        heapq.heapify(self._heap)
+
+    def _next(self) -> int:
+        self._sequence += 1
+        return self._sequence
+
+    def add(self, identifier: str, timestamp: datetime = None) -> int:
+        """Counts an occurrence at timestamp, or now by the clock
+
+        Returns:
+            The number of occurrences within window_seconds of it.
+
+        """
+
+        now = (timestamp or self.clock.now()).timestamp()
+        earliest = now - self.window
+
+        occurrences = self.store.get(identifier)
+        occurrences = self.as_times(occurrences or ())
+        while occurrences and occurrences[0] < earliest:
+            occurrences.popleft()
+        occurrences.append(now)
+        self.store[identifier] = occurrences
+
+        if not self._indexed:
+            if len(self._heap) > 2 * len(self.store) + 1024:
+                self._rebuild()
+            else:
+                heapq.heappush(self._heap,
+                               (now + self.window, self._next(), identifier))
+
+        if self._recent is not None:
+            self._recent.pop(identifier, None)
+            self._recent[identifier] = None
+            while len(self._recent) > self.max_identifiers:
+                (oldest, _) = self._recent.popitem(last=False)
+                self.store.pop(oldest, None)
+
+        return len(occurrences)
 
     def clear(self, identifier: str):
         if identifier in self.store:
             del self.store[identifier]
+        if self._recent is not None:
+            self._recent.pop(identifier, None)
+
+    def evict(self, now: datetime = None) -> int:
+        """Removes the identifiers with no occurrences within the window
+
+        Returns:
+            The number of identifiers removed.
+
+        """
+
+        now = (now or self.clock.now()).timestamp()
+
+        if self._indexed:
+            idle = self.store.older_than(
+                datetime.fromtimestamp(now - self.window))
+        else:
+            idle = []
+            while self._heap and self._heap[0][0] < now:
+                (expires, sequence, identifier) = heapq.heappop(self._heap)
+                occurrences = self.store.get(identifier)
+                if (occurrences and self._last_time(occurrences) + self.window
+                        == expires):
+                    idle.append(identifier)
+
+        for identifier in idle:
+            self.clear(identifier)
+
+        return len(idle)
+
+
+class SpaceSaving:
+    """Approximate counts of the most frequent items, in constant memory
+
+    The Space-Saving algorithm: at most capacity items are counted. When a
+    new item comes and all the counters are taken, the item with the lowest
+    count is replaced by the new one, which takes over that count, plus one,
+    and keeps it as its error. Any item counted more than total / capacity
+    times is guaranteed to be counted, and no count is too low, or too high
+    by more than its error.
+
+    The counters are a dict of item to (count, error) from the module store,
+    so they are persisted with it, and the journal writes only the ones that
+    changed. The lowest count is found with a heap of (count, item). Adding
+    to a counter doesn't update it; an entry whose count is out of date is
+    pushed again with the current count when it comes to the top.
+
+    Args:
+        capacity: Most items to count
+        counters: dict of item to (count, error), from the module store
+
+    """
+
+    def __init__(self, capacity: int, counters: dict):
+        self.capacity = capacity
+        self.counters = counters
+
+        self._heap = [(count, item)
+                      for (item, (count, error)) in counters.items()]
+        heapq.heapify(self._heap)
+
+        # The capacity may have been lowered since the counters were saved
+
+        while len(self.counters) > self.capacity:
+            self._pop_lowest()
+
+    def _pop_lowest(self) -> int:
+        """Removes the item with the lowest count. Returns that count."""
+
+        while True:
+            (count, item) = heapq.heappop(self._heap)
+            (current, error) = self.counters[item]
+            if current == count:
+                del self.counters[item]
+                return count
+            heapq.heappush(self._heap, (current, item))
+
+    def add(self, item, count: int = 1) -> int:
+        """Counts an item. Returns its count."""
+
+        current = self.counters.get(item)
+        if current is not None:
+            total = current[0] + count
+            self.counters[item] = (total, current[1])
+            return total
+
+        error = 0
+        if len(self.counters) >= self.capacity:
+            error = self._pop_lowest()
+
+        total = error + count
+        self.counters[item] = (total, error)
+        heapq.heappush(self._heap, (total, item))
+        return total
+
+    def top(self, count: int) -> list[tuple[object, int]]:
+        """Returns the count items counted most, and their counts"""
+
+        return self.top_of(self.counters, count)
+
+    @staticmethod
+    def top_of(counters: dict, count: int) -> list[tuple[object, int]]:
+        """Like top, for counters that are only read, such as for reports
+
+        Making a SpaceSaving of them would trim them to its capacity.
+
+        """
+
+        return [(item, total) for (item, (total, error)) in heapq.nlargest(
+            count, counters.items(), key=lambda entry: entry[1][0])]
+
+    def clear(self):
+        for item in list(self.counters):
+            del self.counters[item]
+        self._heap = []
+
+    @staticmethod
+    def merge(summaries: list[dict], capacity: int) -> dict:
+        """Combines the counters of several summaries, such as shards
+
+        The counts and errors of an item are added. Only the capacity
+        items with the highest counts are kept.
+
+        """
+
+        merged = {}
+        for counters in summaries:
+            for (item, (count, error)) in counters.items():
+                (total, total_error) = merged.get(item, (0, 0))
+                merged[item] = (total + count, total_error + error)
+
+        return dict(heapq.nlargest(capacity, merged.items(),
+                                   key=lambda entry: entry[1][0]))
+
+
+class MessageClassifier:
+    """Classifies log messages by a literal prefix, then one compiled pattern
+
+    Rules are indexed by the first word of their prefix, so classifying a
+    message is a dict lookup, a startswith check against the few rules for
+    that word (longest prefix first), and at most one regex match. Rules for
+    messages that don't start with a fixed prefix match a literal substring
+    instead. They are only tried when no prefix rule matches. If a rule's
+    pattern doesn't match, the next rule is tried.
+
+    A rule's properties are the named groups of its pattern, added to the
+    constant properties given with the rule.
+
+    """
+
+    def __init__(self):
+        self._prefixes: dict[str, list] = {}
+        self._substrings: list = []
+
+    @staticmethod
+    def _rule(text: str, kind: str, pattern: str | None, constants: dict):
+        return text, kind, re.compile(pattern) if pattern else None, constants
+
+    def add(self, kind: str, prefix: str, pattern: str = None, **constants):
+        """Classifies messages that start with prefix, and match pattern"""
+
+        rules = self._prefixes.setdefault(prefix.partition(' ')[0], [])
+        rules.append(self._rule(prefix, kind, pattern, constants))
+        rules.sort(key=lambda rule: len(rule[0]), reverse=True)
+
+    def add_substring(self, kind: str, substring: str, pattern: str = None,
+                      **constants):
+        """Classifies messages that contain substring, and match pattern"""
+
+        self._substrings.append(
+            self._rule(substring, kind, pattern, constants))
+
+    def classify(self, message: str) -> tuple[str | None, dict | None]:
+        """Returns the kind of a message and its properties
+
+        Returns:
+            (None, None) if no rule matches.
+
+        """
+
+        for (prefix, kind, pattern, constants) in self._prefixes.get(
+                message.partition(' ')[0], ()):
+            if message.startswith(prefix):
+                properties = self._properties(message, pattern, constants)
+                if properties is not None:
+                    return kind, properties
+
+        for (substring, kind, pattern, constants) in self._substrings:
+            if substring in message:
+                properties = self._properties(message, pattern, constants)
+                if properties is not None:
+                    return kind, properties
+
+        return None, None
+
+    @staticmethod
+    def _properties(message: str, pattern: re.Pattern | None,
+                    constants: dict) -> dict | None:
+        if pattern is None:
+            return dict(constants)
+
+        m = pattern.match(message)
+        if not m:
+            return None
+
+        return {**constants, **m.groupdict()}
+
+
+class SessionTracker:
+    """Sessions by identifier, each with a state and a payload, that expire
+
+    A session expires ttl_seconds after it was started or last touched. The
+    payload is a dict, in which the tracker keeps that time as 'timestamp'.
+    The states and payloads are kept in two dicts of the module store, so
+    they are persisted with it.
+
+    When states is None, the payloads are objects, such as slotted
+    dataclasses, that keep the state and the time in their own state and
+    timestamp attributes. One object per session takes much less memory than
+    a dict and an entry in a second dict.
+
+    Expiry times are indexed in a heap, so starting or touching a session is
+    O(log n), and sweep only looks at the sessions that have expired. Heap
+    entries are not removed when a session ends or is touched; they are
+    skipped when they come up. When the payloads are in the sqlite store
+    backend, their timestamp index is used instead of a heap.
+
+    Args:
+        ttl_seconds: Time after which an untouched session expires
+        states: dict of identifier to state, from the module store, or None
+            if the payloads keep their state
+        sessions: dict of identifier to payload, from the module store
+        on_expire: Called as on_expire(identifier, state, payload) for each
+            session that expires, after it has been removed
+        clock: Clock to tell the time with
+
+    """
+
+    def __init__(self, ttl_seconds: float, states: dict | None, sessions: dict,
+                 on_expire: Callable[[str, object, object], None] = None,
+                 clock: WallClock = None):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.states = states
+        self.sessions = sessions
+        self.on_expire = on_expire
+        self.clock = clock or WallClock()
+
+        self._indexed = hasattr(sessions, 'older_than')
+        self._heap = []
+        self._sequence = 0
+
+        if not self._indexed:
+            self._rebuild()
+
+    @staticmethod
+    def payload_timestamp(payload) -> datetime:
+        """Returns the time a payload was started or last touched"""
+
+        if isinstance(payload, dict):
+            return payload['timestamp']
+        return payload.timestamp
+
+    @staticmethod
+    def _set_timestamp(payload, timestamp: datetime):
+        if isinstance(payload, dict):
+            payload['timestamp'] = timestamp
+        else:
+            payload.timestamp = timestamp
+
+    def _rebuild(self):
+        self._heap = [
+            (self.payload_timestamp(payload) + self.ttl, self._next(),
+             identifier)
+            for (identifier, payload) in self.sessions.items()]
+        heapq.heapify(self._heap)
+
+    def _push(self, identifier: str, timestamp: datetime):
+        if self._indexed:
+            return
+
+        # Drop the entries of sessions that ended or were touched, when they
+        # outnumber the live ones
+
+        if len(self._heap) > 2 * len(self.sessions) + 1024:
+            self._rebuild()
+            return
+
+        heapq.heappush(self._heap,
+                       (timestamp + self.ttl, self._next(), identifier))
+
+    def _next(self) -> int:
+        self._sequence += 1
+        return self._sequence
+
+    def __contains__(self, identifier: str) -> bool:
+        return identifier in self.sessions
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def start(self, identifier: str, payload, state=0,
+              now: datetime = None):
+        """Starts a session, replacing any session with the same identifier"""
+
+        timestamp = now or self.clock.now()
+        self._set_timestamp(payload, timestamp)
+        if self.states is None:
+            payload.state = state
+        else:
+            self.states[identifier] = state
+        self.sessions[identifier] = payload
+        self._push(identifier, timestamp)
+        return payload
+
+    def touch(self, identifier: str, now: datetime = None):
+        """Restarts the expiry time of a session"""
+
+        timestamp = now or self.clock.now()
+        self._set_timestamp(self.sessions[identifier], timestamp)
+        self._push(identifier, timestamp)
+
+    def get(self, identifier: str):
+        """Returns the payload of a session, or None"""
+        return self.sessions.get(identifier)
+
+    def state(self, identifier: str):
+        """Returns the state of a session, or None"""
+
+        if self.states is None:
+            payload = self.sessions.get(identifier)
+            return payload.state if payload is not None else None
+        return self.states.get(identifier)
+
+    def set_state(self, identifier: str, state):
+        if self.states is None:
+            self.sessions[identifier].state = state
+        else:
+            self.states[identifier] = state
+
+    def end(self, identifier: str):
+        """Removes a session. Returns its payload, or None."""
+
+        if self.states is not None:
+            self.states.pop(identifier, None)
+        return self.sessions.pop(identifier, None)
+
+    def sweep(self, now: datetime = None) -> int:
+        """Expires the sessions not touched within ttl_seconds of now
+
+        Returns:
+            The number of sessions expired.
+
+        """
+
+        now = now or self.clock.now()
+
+        if self._indexed:
+            expired = self.sessions.older_than(now - self.ttl)
+        else:
+            expired = []
+            while self._heap and self._heap[0][0] < now:
+                (expires, sequence, identifier) = heapq.heappop(self._heap)
+                payload = self.sessions.get(identifier)
+                if (payload is not None and
+                        self.payload_timestamp(payload) + self.ttl == expires):
+                    expired.append(identifier)
+
+        for identifier in expired:
+            state = self.state(identifier)
+            payload = self.end(identifier)
+            if self.on_expire is not None:
+                self.on_expire(identifier, state, payload)
+
+        return len(expired)
 
 
 def process_cmdline_options(cmd_args: argparse.Namespace):
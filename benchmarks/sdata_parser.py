@@ -0,0 +1,117 @@
+""" Structured data parser benchmark
+
+Compares SyslogRecord._parse_sdata with the regex based parser it replaced,
+on records with 0, 5 and 50 SD params.
+
+Usage:
+
+python -m benchmarks.sdata_parser [--number N]
+
+"""
+
+import argparse
+import re
+import timeit
+
+from Correlator.syslog import SyslogRecord
+from Correlator.util import ParserError
+
+
+def legacy_parse_sdata(dataline):
+    """The regex state machine parser, as it was before the rewrite"""
+
+    has_structured_data = False
+    element_id = None
+    state = 1
+    parsed_struc = {}
+
+    def add_param(eid, param_key, param_value):
+        if element_id not in parsed_struc:
+            parsed_struc[eid] = {}
+
+        parsed_struc[eid][param_key] = param_value
+
+    while True:
+        if not dataline:
+            raise ParserError('Ran out of content')
+        if state == 1:
+            if not has_structured_data:
+                m = re.match(r'-\s+(.+)', dataline)
+                if m:
+                    return m.group(1), {}
+
+            m = re.match(r'\[(\w+) (.*)', dataline)
+            if not m:
+                if not has_structured_data:
+                    raise ParserError(
+                        f'SD-DATA {dataline} parse failed ')
+                else:
+                    return dataline.lstrip(), parsed_struc
+            element_id = m.group(1)
+            dataline = m.group(2)
+            state = 2
+            continue
+        elif state == 2:
+            m = re.match(r'](.*)', dataline)
+            if m:
+                dataline = m.group(1)
+                state = 1
+                continue
+            m = re.match(r'(.+?)="([^"]*)"\s*(.*)', dataline)
+
+            if m:
+                add_param(element_id, m.group(1), m.group(2))
+                has_structured_data = True
+                dataline = m.group(3)
+                continue
+            else:
+                raise ParserError(
+                    f'SD-DATA Key/Value {dataline} parse failed')
+
+
+def make_rest(params: int) -> str:
+    """Builds the structured data and message part of a record"""
+
+    message = 'Accepted password for testguy from 192.168.1.85 port 50759 ssh2'
+    if not params:
+        return f'- {message}'
+
+    elements = []
+    for element in range(0, params, 5):
+        pairs = ' '.join(
+            f'param{index}="value number {index}"'
+            for index in range(element, min(element + 5, params)))
+        elements.append(f'[element{element} {pairs}]')
+
+    return f'{"".join(elements)} {message}'
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--number', type=int, default=20000,
+                        help='Number of parses per measurement')
+    cmd_args = parser.parse_args()
+
+    print(f'{"Params":>6} {"Legacy (us)":>12} {"Current (us)":>13} '
+          f'{"Speedup":>8}')
+
+    for params in (0, 5, 50):
+        rest = make_rest(params)
+
+        if legacy_parse_sdata(rest) != SyslogRecord._parse_sdata(rest):
+            raise SystemExit(f'Parsers disagree on {rest}')
+
+        legacy = min(timeit.repeat(
+            lambda: legacy_parse_sdata(rest), number=cmd_args.number,
+            repeat=3))
+        current = min(timeit.repeat(
+            lambda: SyslogRecord._parse_sdata(rest), number=cmd_args.number,
+            repeat=3))
+
+        print(f'{params:>6} {legacy / cmd_args.number * 1e6:>12.2f} '
+              f'{current / cmd_args.number * 1e6:>13.2f} '
+              f'{legacy / current:>7.1f}x')
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,142 @@
+""" SSHD message classifier benchmark
+
+Compares the SSHD module's MessageClassifier with the chain of detect_*
+functions it replaced, on the messages of a capture file repeated a number
+of times. The chain is run in the order process_record tried the functions
+for a record with no session, followed by those for a session in state 0.
+
+Usage:
+
+python -m benchmarks.sshd_classifier [--capture FILE] [--repeat N]
+
+"""
+
+import argparse
+import re
+import time
+
+from Correlator.Module.sshd import SSHD
+from Correlator.syslog import SyslogRecord
+
+
+def detect_invalid_user(string):
+    m = re.match(r'Invalid user (\S+) from (\S+) port (\d+)', string)
+    if m:
+        return {'user': m.group(1), 'addr': m.group(2), 'port': m.group(3)}
+    return None
+
+
+def detect_passwordfailure(string):
+    m = re.match(r'Failed password for (\S+) from (\S+) port (\S+)', string)
+    if not m:
+        m = re.match(r'Failed password for invalid user (\S+) from (\S+) '
+                     r'port (\S+)', string)
+    if m:
+        return {'user': m.group(1), 'addr': m.group(2), 'port': m.group(3)}
+    return None
+
+
+def detect_authfailure(string):
+    m = re.match(r'.+authentication failure;\s+(.+)\s*', string)
+    if m:
+        prop_str = m.group(1).strip()
+        props = dict(x.split('=') for x in re.split(' +', prop_str))
+        if len(props) > 0:
+            return props
+    return None
+
+
+def detect_accepted(string):
+    m = re.match(r'Accepted publickey for (\S+) from (\S+) port (\S+) '
+                 r'ssh2: RSA (\S+)', string)
+    if m:
+        return {'auth': 'rsa', 'user': m.group(1), 'addr': m.group(2),
+                'port': m.group(3), 'key': m.group(4)}
+
+    m = re.match(r'Accepted password for (\S+) from (\S+) port (\S+)', string)
+    if m:
+        return {'auth': 'password', 'user': m.group(1), 'addr': m.group(2),
+                'port': m.group(3), 'key': None}
+    return None
+
+
+def detect_open(string):
+    m = re.match(r'pam_unix\(sshd:session\): session opened for user (\S+) '
+                 r'by (\S+)', string)
+    if m:
+        return {'user': m.group(1), 'by': m.group(2)}
+    return None
+
+
+def detect_close(string):
+    if string.startswith('Connection closed'):
+        return {}
+    if string.startswith('pam_unix(sshd:session): session closed'):
+        return {}
+    return None
+
+
+LEGACY_CHAIN = [
+    ('accepted', detect_accepted),
+    ('auth_failure', detect_authfailure),
+    ('invalid_user', detect_invalid_user),
+    ('password_failure', detect_passwordfailure),
+    ('open', detect_open),
+    ('close', detect_close),
+]
+
+
+def legacy_classify(message: str):
+    for (kind, detect) in LEGACY_CHAIN:
+        props = detect(message)
+        if props is not None:
+            return kind, props
+    return None, None
+
+
+def read_messages(file_name: str) -> list[str]:
+    with open(file_name, 'rb') as input_file:
+        return [SyslogRecord(line).detail
+                for line in input_file.read().split(b'\n') if line]
+
+
+def measure(classify, messages: list[str]) -> float:
+    begin = time.perf_counter()
+    for message in messages:
+        classify(message)
+    return time.perf_counter() - begin
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--capture', default='data/sshd-1.cap',
+                        help='Capture file to take the messages from')
+    parser.add_argument('--repeat', type=int, default=10000,
+                        help='Number of times to repeat the messages')
+    cmd_args = parser.parse_args()
+
+    messages = read_messages(cmd_args.capture)
+    classifier = SSHD.build_classifier()
+
+    for message in messages:
+        (kind, props) = classifier.classify(message)
+        (legacy_kind, legacy_props) = legacy_classify(message)
+        if kind == 'auth_failure':
+            props = dict(item.partition('=')[::2]
+                         for item in props['properties'].split())
+        if (kind, props) != (legacy_kind, legacy_props):
+            raise SystemExit(f'Classifiers disagree on {message}')
+
+    messages = messages * cmd_args.repeat
+
+    legacy = min(measure(legacy_classify, messages) for _ in range(3))
+    current = min(measure(classifier.classify, messages) for _ in range(3))
+
+    print(f'{len(messages)} messages')
+    print(f'detect_* chain:    {legacy / len(messages) * 1e6:.2f} us')
+    print(f'MessageClassifier: {current / len(messages) * 1e6:.2f} us '
+          f'({legacy / current:.1f}x)')
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,127 @@
+""" SSHD open session memory benchmark
+
+Compares the memory taken by open SSHD sessions kept as SSHDTransactions
+with the state dict and transaction dicts they replaced, and the time and
+size of pickling an SSHDStore holding them. The sessions are synthetic:
+users and addresses repeat across sessions, and each is made as a new
+string, as the classifier returns them.
+
+Usage:
+
+python -m benchmarks.sshd_memory [--sessions N]
+
+"""
+
+import argparse
+import pickle
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from Correlator.Module.sshd import SSHDStore, SSHDTransaction
+
+
+def session(index: int, start: datetime) -> tuple[str, dict]:
+    identifier = f'host{index % 100}.example.com.{index}'
+    return identifier, {
+        'timestamp': start + timedelta(seconds=index),
+        'auth': 'password',
+        'user': f'user{index % 50}',
+        'addr': f'10.0.{index // 250 % 250}.{index % 250}',
+        'port': str(1024 + index % 60000),
+        'key': None,
+        'failures': index % 3
+    }
+
+
+def make_legacy(count: int, start: datetime) -> tuple[dict, dict]:
+    states = {}
+    transactions = {}
+    for index in range(count):
+        (identifier, payload) = session(index, start)
+        states[identifier] = 0
+        transactions[identifier] = payload
+    return states, transactions
+
+
+def make_current(count: int, start: datetime) -> dict:
+    transactions = {}
+    for index in range(count):
+        (identifier, payload) = session(index, start)
+        transactions[identifier] = SSHDTransaction.create(**payload)
+    return transactions
+
+
+def allocated(make) -> tuple[object, int]:
+    """Returns what make returns, and the memory it still holds"""
+
+    tracemalloc.start()
+    value = make()
+    (size, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, size
+
+
+def measure(function, repeat: int = 3) -> float:
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def speed(legacy: float, current: float) -> str:
+    if current <= legacy:
+        return f'{legacy / current:.1f}x faster'
+    return f'{current / legacy:.1f}x slower'
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sessions', type=int, default=1000000,
+                        help='Number of open sessions')
+    cmd_args = parser.parse_args()
+
+    count = cmd_args.sessions
+    start = datetime(2023, 2, 20, 15, 12, 47)
+
+    (legacy, legacy_size) = allocated(lambda: make_legacy(count, start))
+    (current, current_size) = allocated(lambda: make_current(count, start))
+
+    for (identifier, payload) in legacy[1].items():
+        converted = SSHDTransaction.from_dict(legacy[0][identifier], payload)
+        if converted != current[identifier]:
+            raise SystemExit(f'Sessions differ for {identifier}')
+
+    legacy_store = SSHDStore(states=legacy[0], transactions=legacy[1])
+    current_store = SSHDStore(transactions=current)
+
+    legacy_pickle = pickle.dumps(legacy_store, pickle.HIGHEST_PROTOCOL)
+    current_pickle = pickle.dumps(current_store, pickle.HIGHEST_PROTOCOL)
+
+    if pickle.loads(current_pickle).transactions != current:
+        raise SystemExit('Sessions differ after pickling')
+
+    legacy_dump = measure(
+        lambda: pickle.dumps(legacy_store, pickle.HIGHEST_PROTOCOL))
+    current_dump = measure(
+        lambda: pickle.dumps(current_store, pickle.HIGHEST_PROTOCOL))
+    legacy_load = measure(lambda: pickle.loads(legacy_pickle))
+    current_load = measure(lambda: pickle.loads(current_pickle))
+
+    print(f'{count} open sessions')
+    print(f'{"":18}{"bytes/session":>14}{"pickle bytes":>14}'
+          f'{"dump":>10}{"load":>10}')
+    print(f'{"dicts:":18}{legacy_size / count:14.0f}{len(legacy_pickle):14}'
+          f'{legacy_dump:9.2f}s{legacy_load:9.2f}s')
+    print(f'{"SSHDTransaction:":18}{current_size / count:14.0f}'
+          f'{len(current_pickle):14}{current_dump:9.2f}s{current_load:9.2f}s')
+    print(f'Memory {legacy_size / current_size:.1f}x smaller')
+    print(f'Pickle dump {speed(legacy_dump, current_dump)}, and load '
+          f'{speed(legacy_load, current_load)}, than with dicts')
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,114 @@
+""" Persistence store load benchmark
+
+Compares loading a store file written as a single pickle with opening a
+sectioned store file, for a store with one large module store and a few
+small ones. Opening the sectioned file is what the server does at startup;
+each section is then loaded when its module first uses it.
+
+Usage:
+
+python -m benchmarks.store_load [--transactions N] [--modules N]
+
+"""
+
+import argparse
+import os
+import pickle
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from Correlator.Module.report import ReportState
+from Correlator.Module.sshd import SSHDStore
+from Correlator.store_file import StoreFile, write_store_file
+
+
+def make_store(transactions: int, modules: int) -> dict:
+    """Builds a full store with a large SSHD store, and small report stores"""
+
+    start = datetime(2023, 2, 20, 15, 12, 47)
+    sshd = SSHDStore()
+
+    for index in range(transactions):
+        identifier = f'host{index % 100}.{index}'
+        sshd.states[identifier] = 0
+        sshd.transactions[identifier] = {
+            'timestamp': start + timedelta(seconds=index),
+            'auth': 'password',
+            'user': f'user{index % 50}',
+            'addr': f'10.0.{index // 250 % 250}.{index % 250}',
+            'port': str(1024 + index % 60000),
+            'key': None,
+            'failures': index % 3
+        }
+
+    full_store = {'OpenSSH': sshd}
+    for index in range(modules):
+        full_store[f'Report{index}'] = ReportState(start, start, index, index)
+
+    return full_store
+
+
+def measure(load, repeat: int = 3) -> float:
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        load()
+        elapsed = time.perf_counter() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--transactions', type=int, default=200000,
+                        help='Number of SSHD transactions in the store')
+    parser.add_argument('--modules', type=int, default=5,
+                        help='Number of small module stores')
+    cmd_args = parser.parse_args()
+
+    full_store = make_store(cmd_args.transactions, cmd_args.modules)
+
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_file = os.path.join(directory, 'legacy.pickle')
+        sectioned_file = os.path.join(directory, 'sectioned.pickle')
+
+        with open(legacy_file, 'wb') as output_file:
+            pickle.dump(full_store, output_file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(0, output_file, pickle.HIGHEST_PROTOCOL)
+
+        with open(sectioned_file, 'wb') as output_file:
+            write_store_file(output_file, full_store, {}, 0)
+
+        def load_legacy():
+            with open(legacy_file, 'rb') as input_file:
+                pickle.load(input_file)
+
+        def open_sectioned():
+            with open(sectioned_file, 'rb') as input_file:
+                StoreFile(input_file)
+
+        def load_small():
+            with open(sectioned_file, 'rb') as input_file:
+                StoreFile(input_file).load('Report0')
+
+        def load_all():
+            with open(sectioned_file, 'rb') as input_file:
+                store_file = StoreFile(input_file)
+                for name in list(store_file.sections):
+                    store_file.load(name)
+
+        legacy = measure(load_legacy)
+        print(f'{cmd_args.transactions} transactions, {cmd_args.modules} '
+              f'small module stores, {os.path.getsize(sectioned_file)} bytes')
+        print(f'Single pickle, load all:      {legacy * 1000:.2f} ms')
+        for (name, load) in [('Sectioned, open:', open_sectioned),
+                             ('Sectioned, load one small:', load_small),
+                             ('Sectioned, load all:', load_all)]:
+            elapsed = measure(load)
+            print(f'{name:30}{elapsed * 1000:.2f} ms '
+                  f'({legacy / elapsed if elapsed else 0:.0f}x)')
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,74 @@
+""" Timestamp parser benchmark
+
+Compares TimestampParser with iso8601.parse_date(...).replace(tzinfo=None),
+on a stream of timestamps where many records share the same second.
+
+Usage:
+
+python -m benchmarks.timestamp_parser [--number N] [--per-second N]
+
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import iso8601
+
+from Correlator.syslog import TimestampParser
+
+
+def legacy_parse(timestamp_str: str) -> datetime:
+    return iso8601.parse_date(timestamp_str).replace(tzinfo=None)
+
+
+def make_timestamps(number: int, per_second: int) -> list[str]:
+    """Builds RFC 5424 timestamps, per_second of them in every second"""
+
+    start = datetime(2023, 2, 20, 15, 12, 47)
+    step = timedelta(microseconds=1000000 // per_second)
+    return [
+        (start + step * index).strftime('%Y-%m-%dT%H:%M:%S.%f') + '-05:00'
+        for index in range(number)]
+
+
+def measure(parse, timestamps: list[str]) -> float:
+    begin = time.perf_counter()
+    for timestamp in timestamps:
+        parse(timestamp)
+    return time.perf_counter() - begin
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--number', type=int, default=200000,
+                        help='Number of timestamps to parse')
+    parser.add_argument('--per-second', type=int, default=1000,
+                        help='Number of timestamps within each second')
+    cmd_args = parser.parse_args()
+
+    timestamps = make_timestamps(cmd_args.number, cmd_args.per_second)
+    timestamps += [
+        '2023-02-20T15:12:47Z', '2023-02-20T15:12:47.7+01:00',
+        '2023-02-20T15:12:47.000001-12:30', '2023-02-20 15:12:47',
+        '20230220T151247Z', '2023-02-20T15:12:47', '2023-02-20T15:12:47.5',
+        '2023-02-20T15:12:47+0100'
+    ]
+
+    parser = TimestampParser()
+    for timestamp in timestamps:
+        if parser.parse(timestamp) != legacy_parse(timestamp):
+            raise SystemExit(f'Parsers disagree on {timestamp}')
+
+    legacy = min(measure(legacy_parse, timestamps) for _ in range(3))
+    current = min(measure(TimestampParser().parse, timestamps)
+                  for _ in range(3))
+
+    print(f'{len(timestamps)} timestamps, {cmd_args.per_second} per second')
+    print(f'iso8601:         {legacy / len(timestamps) * 1e6:.2f} us')
+    print(f'TimestampParser: {current / len(timestamps) * 1e6:.2f} us '
+          f'({legacy / current:.1f}x)')
+
+
+if __name__ == '__main__':
+    cli()